@@ -0,0 +1,491 @@
+#!/usr/bin/env python2
+
+import argparse
+from collections import deque, OrderedDict
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+from docatron import (BuildStats, DocatronParser, DocatronWriter, Line,
+                      LINK_HTML, Node)
+
+
+def _create_links_per_name(writer, html):
+    # The old linker: one regex pass over the document per name.
+    names = sorted(writer._name_node_map.keys(), key=len, reverse=True)
+
+    for name in names:
+        def sub_link(match):
+            return LINK_HTML % {
+                'url': writer._name_node_map[name].url(),
+                'name': match.group(1),
+                'parent_url': writer._name_node_map[name.split('.')[0]].url()
+            }
+
+        html = re.sub(r'@(%ss?)\b' % re.escape(name), sub_link, html)
+    return html
+
+
+def _write_source(path, num_classes, num_functions):
+    with open(path, 'w') as f:
+        for i in xrange(num_classes):
+            f.write('/// class Class%d\n' % i)
+            f.write('/// Class number %d, see @Class%d.\n' %
+                    (i, (i + 1) % num_classes))
+            f.write('function Class%d() {}\n\n' % i)
+            for j in xrange(num_functions):
+                f.write('/// function Class%d.func%d\n' % (i, j))
+                f.write('/// Calls @Class%d.func%d on @Class%ds.\n' %
+                        (i, (j + 1) % num_functions, i))
+                f.write('///\n')
+                f.write('/// Params:\n')
+                f.write('///   x {@Class%d}: The x.\n' % i)
+                f.write('Class%d.func%d = null;\n\n' % (i, j))
+
+
+def _parse(num_classes, num_functions):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'bench.js')
+        _write_source(path, num_classes, num_functions)
+        return DocatronParser([path]).get_nodes()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _time(func, *args):
+    start = time.time()
+    func(*args)
+    return time.time() - start
+
+
+def bench_links(num_classes, num_functions, repeats, per_name):
+    writer = DocatronWriter(_parse(num_classes, num_functions))
+    html = '\n'.join([node.to_html(top_level=True)
+                      for node in writer._nodes.values()])
+
+    print 'create_links (%d names)' % len(writer._name_node_map)
+    print '%10s %12s %12s' % ('repeats', 'html bytes', 'seconds')
+    for repeat in repeats:
+        doc = '\n'.join([html] * repeat)
+        row = '%10d %12d %12.4f' % (repeat, len(doc),
+                                    _time(writer.create_links, doc))
+        if per_name:
+            row += ' (per name: %.4f)' % _time(_create_links_per_name,
+                                               writer, doc)
+        print row
+
+
+def _make_block(num_params):
+    lines = ['class Big', 'A class with %d params.' % num_params, '',
+             'Params:']
+    for i in xrange(num_params):
+        lines.append('  param%d (%d) {int}: Param number %d.' % (i, i, i))
+        lines.append('    More about param %d.' % i)
+    return [Line(line, 2, 'bench.js', i + 1) for i, line in enumerate(lines)]
+
+
+def bench_blocks(sizes):
+    print 'Node parsing of one large block'
+    print '%10s %12s %12s %16s' % ('params', 'lines', 'seconds',
+                                   'usec per line')
+    for size in sizes:
+        block = _make_block(size)
+        num_lines = len(block)
+        seconds = _time(Node, block, 'bench.js', None)
+        print '%10d %12d %12.4f %16.2f' % (size, num_lines, seconds,
+                                           seconds * 1e6 / num_lines)
+
+
+def _make_nodes(num_names):
+    # Classes with nine functions each, every third function with a nested
+    # function, named out of order so parents are not always seen first.
+    nodes = OrderedDict()
+    i = 0
+    while len(nodes) < num_names:
+        names = ['Class%d' % i]
+        for j in xrange(9):
+            names.append('Class%d.func%d' % (i, j))
+            if j % 3 == 0:
+                names.append('Class%d.func%d.inner' % (i, j))
+        for name in reversed(names):
+            nodes[name] = Node([Line('function %s' % name, 2, 'bench.js', 1)],
+                               'bench.js', None)
+        i += 1
+    return nodes
+
+
+def bench_writer(sizes):
+    print 'DocatronWriter construction'
+    print '%10s %12s %16s' % ('names', 'seconds', 'usec per name')
+    for size in sizes:
+        nodes = _make_nodes(size)
+        seconds = _time(DocatronWriter, nodes)
+        print '%10d %12.4f %16.2f' % (len(nodes), seconds,
+                                      seconds * 1e6 / len(nodes))
+
+
+def _deep_size(obj, seen):
+    # Sums sys.getsizeof over everything reachable from obj, counting shared
+    # objects once.
+    size = 0
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen or isinstance(obj, (type, type(_deep_size))):
+            continue
+        seen.add(id(obj))
+
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.iterkeys())
+            stack.extend(obj.itervalues())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            stack.extend(obj)
+
+        if hasattr(obj, '__dict__'):
+            stack.append(obj.__dict__)
+        for cls in type(obj).__mro__:
+            for slot in cls.__dict__.get('__slots__', ()):
+                if hasattr(obj, slot):
+                    stack.append(getattr(obj, slot))
+    return size
+
+
+def _unslotted(obj, copies, classes):
+    # Copies obj with every instance of a class with __slots__ replaced by an
+    # instance of a plain class with the same attributes, as the classes were
+    # before they had __slots__. Everything else is shared with obj.
+    if id(obj) in copies:
+        return copies[id(obj)]
+
+    if isinstance(obj, dict):
+        copy = copies[id(obj)] = type(obj)()
+        for key, value in obj.iteritems():
+            copy[key] = _unslotted(value, copies, classes)
+    elif isinstance(obj, (list, deque)):
+        copy = copies[id(obj)] = type(obj)()
+        copy.extend([_unslotted(value, copies, classes) for value in obj])
+    elif isinstance(obj, tuple):
+        copy = copies[id(obj)] = tuple([_unslotted(value, copies, classes)
+                                        for value in obj])
+    elif any(['__slots__' in cls.__dict__ for cls in type(obj).__mro__]):
+        cls = type(obj)
+        if cls not in classes:
+            classes[cls] = type(cls.__name__, (object,), {})
+        copy = copies[id(obj)] = classes[cls]()
+        for base in cls.__mro__:
+            for slot in base.__dict__.get('__slots__', ()):
+                if hasattr(obj, slot):
+                    setattr(copy, slot,
+                            _unslotted(getattr(obj, slot), copies, classes))
+    else:
+        copy = copies[id(obj)] = obj
+    return copy
+
+
+def bench_memory(num_classes, num_functions):
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'bench.js')
+        _write_source(path, num_classes, num_functions)
+        with open(path) as f:
+            lines = [Line(line[4:], 2, path, i + 1)
+                     for i, line in enumerate(f) if line.startswith('///')]
+        nodes = DocatronParser([path]).get_nodes()
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    writer = DocatronWriter(nodes)
+    num_symbols = len(writer._name_node_map)
+    print 'Memory for %d symbols' % num_symbols
+    print '%-28s %10s %10s' % ('', 'unslotted', 'slotted')
+
+    # The unslotted copies share everything but the instances with the
+    # originals, so each is measured with its own seen set.
+    copies = {}
+    classes = {}
+    measured = []
+    for objs in [(lines, nodes, writer._nodes),
+                 (_unslotted(lines, copies, classes),
+                  _unslotted(nodes, copies, classes),
+                  _unslotted(writer._nodes, copies, classes))]:
+        # Strings and ints are shared with the nodes, so only count them
+        # once.
+        seen = set()
+        line_bytes = _deep_size(objs[0], set())
+        node_bytes = _deep_size(objs[1], seen)
+        writer_bytes = _deep_size(objs[2], seen)
+        measured.append((line_bytes / len(lines), node_bytes / num_symbols,
+                         writer_bytes / num_symbols))
+
+    slotted, unslotted = measured
+    for i, label in enumerate(['bytes per Line', 'Node bytes per symbol',
+                               'WriterNode bytes per symbol']):
+        print '%-28s %10d %10d' % (label, unslotted[i], slotted[i])
+
+
+_TYPES = ['int', 'string', 'boolean', 'Object', 'function', 'number']
+
+
+class _CorpusWriter(object):
+    def __init__(self, f, rand, names, links):
+        self._f = f
+        self._rand = rand
+        self._names = names
+        self._links = links
+
+    def line(self, text=''):
+        self._f.write(('/// %s' % text).rstrip() + '\n')
+
+    def code(self, text):
+        self._f.write('%s\n\n' % text)
+
+    def type(self):
+        # Some types link to other classes.
+        if self._rand.random() < 0.3:
+            return '@%s' % self._rand.choice(self._names)
+        return self._rand.choice(_TYPES)
+
+    def text(self, words):
+        text = []
+        for i in xrange(words):
+            text.append(self._rand.choice(['the', 'a', 'value', 'of', 'is',
+                                           'returns', 'when', 'called']))
+        for i in xrange(self._links):
+            name = self._rand.choice(self._names)
+            text.insert(self._rand.randint(0, len(text)),
+                        '@%s%s' % (name, self._rand.choice(['', '', 's'])))
+        if self._rand.random() < 0.2:
+            text.append('|inline_code()|')
+        return ' '.join(text) + '.'
+
+    def params(self, num_params):
+        self.line('Params:')
+        for i in xrange(num_params):
+            name = 'param%d' % i
+            if self._rand.random() < 0.3:
+                name = '[%s]' % name
+            if self._rand.random() < 0.3:
+                name = '%s (%d)' % (name, self._rand.randint(0, 100))
+            self.line('  %s {%s}: %s' % (name, self.type(), self.text(6)))
+            if self._rand.random() < 0.3:
+                self.line('    %s' % self.text(8))
+
+    def example(self):
+        self.line()
+        self.line('    var x = new Thing();')
+        self.line('      x.call(1, 2);')
+        self.line()
+
+
+## function generate_corpus
+## Writes a synthetic source tree of DOCATRON comments.
+##
+## Params:
+##   directory {string}: The directory to write the tree to.
+##   num_files {int}: The number of source files.
+##   classes (10) {int}: Classes per file.
+##   functions (8) {int}: Functions per class.
+##   params (3) {int}: Params per function.
+##   links (2) {int}: @Name references per description.
+##   seed (0) {int}: Seed for the random choices.
+##
+## Returns:
+##   {string[]}: The files that were written.
+def generate_corpus(directory, num_files, classes=10, functions=8, params=3,
+                    links=2, seed=0):
+    rand = random.Random(seed)
+    class_names = ['Class%d' % i for i in xrange(num_files * classes)]
+    files = []
+    for i in xrange(num_files):
+        package_dir = os.path.join(directory, 'pkg%d' % (i / 100))
+        if not os.path.isdir(package_dir):
+            os.makedirs(package_dir)
+        path = os.path.join(package_dir, 'module%d.js' % i)
+        files.append(path)
+
+        with open(path, 'w') as f:
+            w = _CorpusWriter(f, rand, class_names, links)
+            w.code('"use strict";')
+            for class_name in class_names[i * classes:(i + 1) * classes]:
+                w.line('class %s' % class_name)
+                w.line(w.text(12))
+                w.example()
+                w.line(w.text(10))
+                w.line()
+                w.params(params)
+                w.code('function %s() {}' % class_name)
+
+                for j in xrange(functions):
+                    w.line('function %s.method%d' % (class_name, j))
+                    w.line(w.text(10))
+                    w.line()
+                    w.params(params)
+                    w.line()
+                    w.line('Returns:')
+                    w.line('  {%s}: %s' % (w.type(), w.text(5)))
+                    w.code('%s.prototype.method%d = function() {};' %
+                           (class_name, j))
+
+                w.line('property %s.count {int}' % class_name)
+                w.line(w.text(6))
+                w.code('var count = 0;')
+
+                w.line('event %s.changed' % class_name)
+                w.line(w.text(6))
+                w.line()
+                w.params(1)
+                w.code('// emit("changed")')
+    return files
+
+
+class _NullFile(object):
+    def write(self, text):
+        pass
+
+
+def bench_suite(scales, classes, functions, params, links, output):
+    results = []
+    print '%8s %10s %10s %10s %10s %10s %10s' % (
+        'files', 'symbols', 'parse', 'tree', 'render', 'links', 'total')
+    for num_files in scales:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            files = generate_corpus(tmp_dir, num_files, classes, functions,
+                                    params, links)
+            num_bytes = sum([os.path.getsize(f) for f in files])
+
+            stats = BuildStats()
+            start = time.time()
+            nodes = DocatronParser(files, stats=stats).get_nodes()
+            writer = DocatronWriter(nodes, stats=stats)
+            writer.write_html(_NullFile())
+            total = time.time() - start
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        phase_list = stats.to_dict()['phases']
+        phases = dict([(phase['name'], phase) for phase in phase_list])
+        seconds = lambda *names: sum([phases[n]['seconds'] for n in names
+                                      if n in phases])
+        result = {
+            'files': num_files,
+            'bytes': num_bytes,
+            'symbols': len(writer._name_node_map),
+            'seconds': {
+                'parse': seconds('read', 'scan', 'parse'),
+                'tree': seconds('tree'),
+                'render': seconds('render', 'toc'),
+                'links': seconds('link'),
+                'total': total
+            },
+            'phases': phase_list
+        }
+        results.append(result)
+        print '%8d %10d %10.3f %10.3f %10.3f %10.3f %10.3f' % (
+            num_files, result['symbols'], result['seconds']['parse'],
+            result['seconds']['tree'], result['seconds']['render'],
+            result['seconds']['links'], total)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'settings': {
+                    'classes': classes,
+                    'functions': functions,
+                    'params': params,
+                    'links': links
+                },
+                'results': results
+            }, f, indent=2)
+
+
+def _sizes(text):
+    return [int(s) for s in text.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('DOCATRON benchmarks')
+    subparsers = parser.add_subparsers(dest='bench')
+
+    links = subparsers.add_parser('links', help='Time create_links')
+    links.add_argument('--classes', type=int, default=500,
+                       help='Classes to generate')
+    links.add_argument('--functions', type=int, default=5,
+                       help='Functions to generate per class')
+    links.add_argument('--repeats', type=_sizes, default='1,2,4,8,16',
+                       help='Comma separated document size multipliers')
+    links.add_argument('--per-name', action='store_true',
+                       help='Also time the old one-pass-per-name linker')
+
+    blocks = subparsers.add_parser('blocks',
+                                   help='Time parsing very large blocks')
+    blocks.add_argument('--sizes', type=_sizes, default='1000,10000,100000',
+                        help='Comma separated numbers of params per block')
+
+    writer = subparsers.add_parser(
+        'writer', help='Time building the tree of top level nodes')
+    writer.add_argument('--sizes', type=_sizes, default='10000,100000,1000000',
+                        help='Comma separated numbers of names')
+
+    memory = subparsers.add_parser(
+        'memory', help='Measure memory used by parsed lines and nodes')
+    memory.add_argument('--classes', type=int, default=1000,
+                        help='Classes to generate')
+    memory.add_argument('--functions', type=int, default=5,
+                        help='Functions to generate per class')
+
+    suite = subparsers.add_parser(
+        'suite', help='Time every phase on generated corpora of several sizes')
+    suite.add_argument('--scales', type=_sizes, default='10,100,1000',
+                       help='Comma separated numbers of files to generate')
+    suite.add_argument('--classes', type=int, default=10,
+                       help='Classes per file')
+    suite.add_argument('--functions', type=int, default=8,
+                       help='Functions per class')
+    suite.add_argument('--params', type=int, default=3,
+                       help='Params per function')
+    suite.add_argument('--links', type=int, default=2,
+                       help='@Name references per description')
+    suite.add_argument('-o', help='File to write the results to as JSON')
+
+    generate = subparsers.add_parser(
+        'generate', help='Write a generated corpus to a directory')
+    generate.add_argument('directory', help='The directory to write to')
+    generate.add_argument('--files', type=int, default=100,
+                          help='Number of files to generate')
+    generate.add_argument('--classes', type=int, default=10,
+                          help='Classes per file')
+    generate.add_argument('--functions', type=int, default=8,
+                          help='Functions per class')
+    generate.add_argument('--params', type=int, default=3,
+                          help='Params per function')
+    generate.add_argument('--links', type=int, default=2,
+                          help='@Name references per description')
+    generate.add_argument('--seed', type=int, default=0,
+                          help='Seed for the random choices')
+
+    args = parser.parse_args()
+    if args.bench == 'links':
+        bench_links(args.classes, args.functions, args.repeats, args.per_name)
+    elif args.bench == 'blocks':
+        bench_blocks(args.sizes)
+    elif args.bench == 'writer':
+        bench_writer(args.sizes)
+    elif args.bench == 'memory':
+        bench_memory(args.classes, args.functions)
+    elif args.bench == 'suite':
+        bench_suite(args.scales, args.classes, args.functions, args.params,
+                    args.links, args.o)
+    elif args.bench == 'generate':
+        generate_corpus(args.directory, args.files, args.classes,
+                        args.functions, args.params, args.links, args.seed)
@@ -42,6 +42,24 @@ TYPE_RE = r'.*{(?P<type>[^}]+)}'
 CODE_RE = r'\|([^\s]+)\|'
 
 
+###############################
+# File discovery for DOCATRON #
+###############################
+
+# Files in each searched directory that list paths to skip, with .gitignore
+# syntax
+IGNORE_FILES = ['.gitignore', '.docatronignore']
+
+# Paths never searched when a directory is given, so vendored code and binary
+# files are not opened
+DEFAULT_EXCLUDE = [
+    '.git', '.hg', '.svn', 'node_modules', 'bower_components', 'vendor',
+    'third_party', '*.min.js', '*.map', '*.pyc', '*.pyo', '*.so', '*.o',
+    '*.a', '*.dll', '*.exe', '*.class', '*.jar', '*.zip', '*.gz', '*.tar',
+    '*.png', '*.jpg', '*.jpeg', '*.gif', '*.ico', '*.pdf', '*.woff', '*.ttf'
+]
+
+
 #####################
 # HTML for DOCATRON #
 #####################
@@ -66,6 +84,10 @@ BASE_HTML = '''<!doctype html>
 # A link created to a DOCATRON item
 LINK_HTML = '<a href="#%(url)s" data-parent="%(parent_url)s">%(name)s</a>'
 
+# A link to a DOCATRON item on another page, when writing one page per top
+# level item
+PAGE_LINK_HTML = '<a href="%(page)s#%(url)s" data-parent="%(parent_url)s">%(name)s</a>'
+
 # A top level item
 BASE_ITEM_HTML = '<div>\n%s\n</div>'
 
@@ -131,12 +153,43 @@ TOP_LEVEL_LINK_TOC = '<a data-toggle="%(url)s" class="toc-top" href="#%(url)s">%
 # A link in the TOC
 LINK_TOC = '<a href="#%(url)s" data-parent="%(parent_url)s">%(name)s</a>'
 
+# TOC links when writing one page per top level item
+PAGE_TOP_LEVEL_LINK_TOC = '<a data-toggle="%(url)s" class="toc-top" href="%(page)s#%(url)s">%(name)s</a>'
+PAGE_LINK_TOC = '<a href="%(page)s#%(url)s" data-parent="%(parent_url)s">%(name)s</a>'
+
+# Used in place of the TOC on the page of a single top level item
+PAGE_TOC_HTML = '<div id="toc"><a href="%(index)s">Index</a></div>'
+
 # The TOC container
 BASE_TOC = '<div id="toc"><ul>\n%s\n</ul></div>'
 
 # A top level TOC item
 FIRST_LEVEL_TOC = '<li>%s</li>'
 
+# The TOC container when the TOC is collapsed. Each top level item's child
+# list is only loaded, from a JSON fragment with the list's HTML in "html",
+# when the item is first clicked.
+COLLAPSED_BASE_TOC = '''<div id="toc"><ul>
+%s
+</ul></div>
+<script>
+document.getElementById('toc').addEventListener('click', function(e) {
+  var item = e.target.parentNode;
+  var url = item.getAttribute && item.getAttribute('data-toc-children');
+  if (!url) return;
+  item.removeAttribute('data-toc-children');
+  var request = new XMLHttpRequest();
+  request.onload = function() {
+    item.insertAdjacentHTML('beforeend', JSON.parse(request.responseText).html);
+  };
+  request.open('GET', url);
+  request.send();
+});
+</script>'''
+
+# A top level TOC item with children when the TOC is collapsed
+COLLAPSED_FIRST_LEVEL_TOC = '<li data-toc-children="%(children)s">%(link)s</li>'
+
 # A second level TOC container
 SECOND_BASE_TOC = '<ul>\n%s\n</ul>'
 
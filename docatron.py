@@ -1,81 +1,411 @@
 #!/usr/bin/env python2
 
 import argparse
-from collections import OrderedDict
+import bisect
+from collections import deque, OrderedDict
+from contextlib import contextmanager
+import cPickle
+import filecmp
+import functools
+import glob
+import hashlib
+from itertools import izip
+import json
+import marshal
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import os
 import re
+import resource
+import sqlite3
+import string
 import sys
+import threading
+import time
+import zlib
 
 from config import *
 
 class DocatronSyntaxError(Exception):
     def __init__(self, message, filename, lineno):
         Exception.__init__(self, '%s: %s line %d' % (message, filename, lineno))
+        self._args = (message, filename, lineno)
 
+    # Rebuild from the original arguments so errors raised in worker
+    # processes can be sent back to the parent.
+    def __reduce__(self):
+        return (DocatronSyntaxError, self._args)
 
-def _indent_block(text):
-    return '\n'.join(['  %s' % line for line in text.split('\n')])
 
+_PLACEHOLDER = '\0%s\0'
 
-def _indent_line(line, indent):
-    return (' ' * indent) + line
+
+# Splits a template around its placeholders. Returns the static text and the
+# placeholder keys alternately, starting and ending with static text.
+def _split_template(template, keys):
+    if keys == ['']:
+        text = template % (_PLACEHOLDER % '')
+    else:
+        text = template % dict([(k, _PLACEHOLDER % k) for k in keys])
+    return re.split(_PLACEHOLDER % r'(\w*)', text)
+
+
+# Collects rendered HTML, indenting every line written while a placeholder
+# is open by two spaces per level, instead of splitting and joining the text
+# again at every level of nesting. Text from DOCATRON comments is passed
+# through convert with its references, which turns code and link syntax into
+# HTML. When f is given, the HTML is written straight to it instead of being
+# collected.
+class _HtmlBuffer(object):
+    __slots__ = ('_parts', '_newlines', '_convert', '_append')
+
+    def __init__(self, convert=None, f=None):
+        self._parts = []
+        self._newlines = ['\n']
+        self._convert = convert
+        self._append = f.write if f is not None else self._parts.append
+
+    def text(self, text, references=()):
+        # Most text has no code or links, so it is checked for first.
+        if self._convert is None or (not references and '|' not in text):
+            return text
+        return self._convert(text, references)
+
+    def converts(self):
+        return self._convert is not None
+
+    def write(self, text):
+        if len(self._newlines) > 1:
+            text = text.replace('\n', self._newlines[-1])
+        self._append(text)
+
+    def indent(self):
+        self._append('  ')
+        self._newlines.append(self._newlines[-1] + '  ')
+
+    def dedent(self):
+        self._newlines.pop()
+
+    def getvalue(self):
+        return ''.join(self._parts)
+
+
+# A template from config.py, split around its placeholders once. Values are
+# strings, or callables that render into the buffer. Placeholders listed in
+# indented are indented one level.
+class _Template(object):
+    __slots__ = ('_parts', '_indented')
+
+    def __init__(self, template, keys, indented=()):
+        self._parts = _split_template(template, keys)
+        self._indented = frozenset(indented)
+
+    def render(self, out, values):
+        for i, part in enumerate(self._parts):
+            if i % 2 == 0:
+                out.write(part)
+                continue
+
+            indented = part in self._indented
+            if indented:
+                out.indent()
+            value = values[part]
+            if callable(value):
+                value(out)
+            else:
+                out.write(value)
+            if indented:
+                out.dedent()
 
 
-def _is_params(text):
-    return re.match(PARAM_SECTION_RE, text.lower())
+_BASE_HTML = _Template(BASE_HTML, ['toc', 'content'], ['toc', 'content'])
+_BASE_ITEM = _Template(BASE_ITEM_HTML, [''], [''])
+_FIRST_LEVEL_CONTAINER = _Template(FIRST_LEVEL_CONTAINER_HTML,
+                                   ['url', 'content'], ['content'])
+_PARAM_LIST = _Template(PARAM_LIST_HTML, ['section', 'content'], ['content'])
+_PROPERTY_LIST = _Template(PROPERTY_LIST_HTML, ['section', 'content'],
+                           ['content'])
+_PARAM_ITEM = _Template(PARAM_ITEM_HTML, [''], [''])
+_BASE_TOC = _Template(BASE_TOC, [''], [''])
+_COLLAPSED_BASE_TOC = _Template(COLLAPSED_BASE_TOC, [''], [''])
 
 
-def _is_optional(text):
-    return (re.match(OPTIONAL_PARAM_RE, text) or
-        re.match(OPTIONAL_PARAM_DEFAULT_RE, text))
+# Renders a list of items into the buffer, one per line.
+def _render_lines(out, items, render):
+    for i, item in enumerate(items):
+        if i:
+            out.write('\n')
+        render(out, item)
 
 
-def _is_param(text):
-    return any([re.match(regex, text) for regex in
-        [PARAM_RE, OPTIONAL_PARAM_RE, PARAM_DEFAULT_RE,
-         OPTIONAL_PARAM_DEFAULT_RE]])
+# Renders a @Node or @WriterNode as an item of a param or property list.
+def _render_param_item(out, node):
+    _PARAM_ITEM.render(out, {'': node._render})
 
 
-def _is_return(text):
-    return re.match(RETURN_SECTION_RE, text.lower())
+def _indent_line(line, indent):
+    return (' ' * indent) + line
 
 
-def _parse_line(regex_list, line):
-    for regex in regex_list:
-        result = re.match(regex, line)
-        if result:
-            return (result.groupdict(),
-                    line.replace(result.group(0), '', 1).strip())
+## class Grammar
+## The regexes from config.py, compiled once and shared by everything that
+## parses DOCATRON lines.
+class Grammar(object):
+    PARAMS = 'params'
+    PARAM = 'param'
+    RETURN = 'return'
+
+    def __init__(self):
+        self.params_section_re = re.compile(PARAM_SECTION_RE)
+        self.return_section_re = re.compile(RETURN_SECTION_RE)
+        # Optional params are tried first, and params with defaults before
+        # those without, so the first match is the most specific one.
+        self.param_res = [
+            (re.compile(OPTIONAL_PARAM_DEFAULT_RE), True),
+            (re.compile(OPTIONAL_PARAM_RE), True),
+            (re.compile(PARAM_DEFAULT_RE), False),
+            (re.compile(PARAM_RE), False)
+        ]
+        self.return_re = re.compile(RETURN_RE)
+        self.type_re = re.compile(TYPE_RE)
+        self.code_re = re.compile(CODE_RE)
+
+    ## function Grammar.is_section
+    ## Checks if a line starts a params or returns section.
+    ##
+    ## Params:
+    ##   text {string}: The text of the line.
+    ##
+    ## Returns:
+    ##   {boolean}: Whether the line starts a section.
+    def is_section(self, text):
+        text = text.lower()
+        return bool(self.params_section_re.match(text) or
+                    self.return_section_re.match(text))
+
+    ## function Grammar.classify
+    ## Classifies a line inside a block with a single match per regex.
+    ##
+    ## Params:
+    ##   text {string}: The text of the line.
+    ##
+    ## Returns:
+    ##   {tuple}: The kind of line (one of PARAMS, PARAM, RETURN or None), the
+    ##     match and whether the line is an optional param.
+    def classify(self, text):
+        lower = text.lower()
+        match = self.params_section_re.match(lower)
+        if match:
+            return Grammar.PARAMS, match, False
+
+        for regex, optional in self.param_res:
+            match = regex.match(text)
+            if match:
+                return Grammar.PARAM, match, optional
+
+        match = self.return_section_re.match(lower)
+        if match:
+            return Grammar.RETURN, match, False
+        return None, None, False
+
+
+_GRAMMAR = Grammar()
+
+
+# Finds the longest name in names that is a dotted prefix of name, checking
+# one prefix per dot from the right.
+def _get_parent_name(name, names):
+    i = name.rfind('.')
+    while i != -1:
+        prefix = name[:i]
+        if prefix in names:
+            return prefix
+        i = name.rfind('.', 0, i)
     return None
 
 
+_SUMMARY_LENGTH = 160
+
+
+# Strips DOCATRON link and code syntax, leaving plain text.
+def _to_text(text):
+    return _GRAMMAR.code_re.sub(r'\1', re.sub(r'@(?=\w)', '', text))
+
+
+# Gets the first sentence of the first paragraph of a description as plain
+# text, shortened to _SUMMARY_LENGTH characters.
+def _get_summary(description):
+    if not description:
+        return ''
+    for is_example, text in description.description:
+        text = text.strip()
+        if is_example or not text:
+            continue
+        end = text.find('. ')
+        if end != -1:
+            text = text[:end + 1]
+        text = _to_text(text)
+        if len(text) > _SUMMARY_LENGTH:
+            text = text[:_SUMMARY_LENGTH - 3].rstrip() + '...'
+        return text
+    return ''
+
+
+_WORD_CHARS = frozenset(string.ascii_letters + string.digits + '_')
+# The characters the name in a warning about an unresolved reference can
+# start with, and can have besides the characters used in names.
+_REFERENCE_START_CHARS = frozenset(string.ascii_letters + '_$')
+_NAME_CHARS = _WORD_CHARS | frozenset('$.')
+
+
+# Whether a regex \b would match at index i of text.
+def _is_word_boundary(text, i):
+    return ((i > 0 and text[i - 1] in _WORD_CHARS) !=
+            (i < len(text) and text[i] in _WORD_CHARS))
+
+
+# An "@" and the run of characters after it that can be part of a name.
+# Which name it is, if any, is only known once every file is parsed, so
+# whitespace, "@" and the "|" of code syntax are all that end it.
+_REFERENCE_RE = re.compile(r'@[^\s@|]*')
+
+
+# Finds the "@Name" references in a line of text from a DOCATRON comment
+# when it is parsed. Returns the start and end of each and its line number,
+# one after the other in a flat tuple, which is much smaller than a tuple
+# per reference when there are hundreds of thousands of them.
+def _find_references(text, lineno):
+    references = ()
+    for match in _REFERENCE_RE.finditer(text):
+        references += match.span() + (lineno,)
+    return references
+
+
+# Iterates over the start, end and line number of each reference in a tuple
+# from _find_references.
+def _iter_references(references):
+    return izip(references[::3], references[1::3], references[2::3])
+
+
+# Indents the lines of an example with EXAMPLE_LEADING_SPACE and ends them
+# with EXAMPLE_END, before its code and links are converted. Returns the HTML
+# and the references moved to where they are in it.
+def _get_example_html(text, references):
+    lines = []
+    # The end of each line in the text and how far its references move.
+    shifts = []
+    start = 0
+    html_start = 0
+    for line in text.split('\n'):
+        stripped = line.lstrip(' ')
+        spaces = len(line) - len(stripped)
+        lines.append(EXAMPLE_LEADING_SPACE * spaces + stripped)
+        shifts.append((start + len(line), html_start - start + spaces *
+                       (len(EXAMPLE_LEADING_SPACE) - 1)))
+        start += len(line) + 1
+        html_start += len(lines[-1]) + len(EXAMPLE_END)
+
+    moved = ()
+    for reference_start, reference_end, lineno in _iter_references(references):
+        for line_end, shift in shifts:
+            if reference_start < line_end:
+                break
+        moved += (reference_start + shift, reference_end + shift, lineno)
+    return EXAMPLE_END.join(lines), moved
+
+
+# Replaces the parts of text between start and end that are in replacements,
+# which has the start, end and new text of each part in order.
+def _replace(text, replacements, start, end):
+    parts = []
+    for replace_start, replace_end, new_text in replacements:
+        if start <= replace_start < end:
+            parts.append(text[start:replace_start])
+            parts.append(new_text)
+            start = replace_end
+    parts.append(text[start:end])
+    return ''.join(parts)
+
+
+# Returns the match's groups and the rest of the line after the match.
+def _split_match(match, line):
+    return match.groupdict(), line[match.end():].strip()
+
+
 class _Description(object):
+    __slots__ = ('description', 'references')
+
     def __init__(self, block, indent, first_line, lineno):
-        # List of tuples of the form (is_example, text).
+        # Tuple of tuples of the form (is_example, text).
         self.description = []
+        # The references in each text, from _find_references, or None if
+        # there are none at all.
+        self.references = None
         self._parse(block, indent, first_line, lineno)
+        self.description = tuple(self.description)
+        if self.references is not None:
+            self.references = tuple(self.references)
 
     def __nonzero__(self):
         return len(self.description)
 
-    def to_html(self):
+    # Iterates over whether each paragraph or example is an example, its text
+    # and its references.
+    def iter_texts(self):
+        references = self.references or ((),) * len(self.description)
+        for (is_example, text), text_references in izip(self.description,
+                                                        references):
+            yield is_example, text, text_references
+
+    def to_html(self, out=None):
         html = []
-        for is_example, line in self.description:
+        for is_example, line, references in self.iter_texts():
             if is_example:
-                html.append(EXAMPLE_HTML % re.sub(
-                    r'(^|\n)( +)',
-                    lambda m: m.group(1) + EXAMPLE_LEADING_SPACE *
-                        len(m.group(2)),
-                    line).replace('\n', EXAMPLE_END))
-            else:
-                html.append(DESCRIPTION_HTML % line)
+                line, references = _get_example_html(line, references)
+            if out is not None:
+                line = out.text(line, references)
+            html.append((EXAMPLE_HTML if is_example else DESCRIPTION_HTML) %
+                        line)
         return '\n'.join(html)
 
+    # Adds a paragraph or example made of lines, finding the references in
+    # it with the line number of the line each is on.
+    def _append(self, is_example, sep, lines, linenos, strip=False):
+        text = sep.join(lines)
+        start = 0
+        if strip:
+            start = len(text.lstrip()) - len(text)
+            text = text.strip()
+
+        if '@' not in text:
+            if self.references is not None:
+                self.references.append(())
+            self.description.append((is_example, text))
+            return
+
+        if len(lines) == 1:
+            references = _find_references(text, linenos[0])
+        else:
+            starts = []
+            for line in lines:
+                starts.append(start)
+                start += len(line) + len(sep)
+            references = ()
+            for match in _REFERENCE_RE.finditer(text):
+                references += match.span() + (
+                    linenos[bisect.bisect_right(starts, match.start()) - 1],)
+
+        if self.references is None:
+            self.references = [()] * len(self.description)
+        self.references.append(references)
+        self.description.append((is_example, text))
+
     def _parse(self, block, indent, first_line, lineno):
         def indent_example(line):
             return ('  ' * (line.indent - indent - 3)) + line.text
 
-        final_desc = []
         desc_list = [first_line]
+        linenos = [lineno]
         prev_lineno = lineno
         was_example = False
         sep = ' '
@@ -89,37 +419,41 @@ class _Description(object):
             if is_example and was_example:
                 if desc_line.lineno > prev_lineno + 1:
                     desc_list.append('')
+                    linenos.append(prev_lineno + 1)
             elif (desc_line.lineno > prev_lineno + 1 or
                     is_example != was_example):
                 if desc_list:
-                    self.description.append((was_example, sep.join(desc_list)))
+                    self._append(was_example, sep, desc_list, linenos)
                 desc_list = []
+                linenos = []
 
             prev_lineno = desc_line.lineno
 
-            if _is_params(desc_line.text) or _is_return(desc_line.text):
+            if _GRAMMAR.is_section(desc_line.text):
                 break
 
             if desc_line.indent < indent + 1:
                 break
 
-            block.pop(0)
+            block.popleft()
             if is_example:
                 desc_list.append(indent_example(desc_line))
             else:
                 desc_list.append(desc_line.text)
+            linenos.append(desc_line.lineno)
 
             was_example = is_example
 
         if desc_list:
-            self.description.append((was_example, sep.join(desc_list).strip()))
+            self._append(was_example, sep, desc_list, linenos, strip=True)
 
 
 ## class Node
 ## Represents a single piece of docatron data.
 ##
 ## Params:
-##   block {@Line[]}: The lines to be parsed.
+##   block {@Line[]}: The lines to be parsed. Lines are consumed from the
+##     front as they are parsed, so a deque is used for the whole block.
 ##   filename {string}: The file this node is a part of.
 ##   parent {@Node}: The parent node.
 class Node(object):
@@ -131,6 +465,12 @@ class Node(object):
 
     TOP_LEVEL_TYPES = (CLASS, OBJECT, FUNCTION, PROPERTY, EVENT)
 
+    # There can be hundreds of thousands of nodes, so they have no __dict__.
+    __slots__ = ('name', 'filename', 'lineno', 'parent', 'children',
+                 'return_type', 'return_description', 'default', 'description',
+                 'type', 'top_level_type', 'params_text', 'optional',
+                 'references', '_url', '_short_name', '_full_name')
+
     @staticmethod
     def section_to_str(section):
         if section == Node.PROPERTY:
@@ -138,12 +478,16 @@ class Node(object):
         return section.capitalize() + 's'
 
     def __init__(self, block, filename, parent):
+        if not isinstance(block, deque):
+            block = deque(block)
+
         self.name = None
         self.filename = filename
         self.lineno = block[0].lineno
         self.parent = parent
 
-        self.children = []
+        # Shared until the first child is added.
+        self.children = ()
         self.return_type = None
         self.return_description = None
         self.default = None
@@ -152,6 +496,14 @@ class Node(object):
         self.top_level_type = None
         self.params_text = None
         self.optional = False
+        # Each field with "@Name" references and the references from
+        # _find_references, or None if there are none.
+        self.references = None
+
+        # Cached by url, get_short_name and get_full_name.
+        self._url = None
+        self._short_name = None
+        self._full_name = None
 
         self._parse_block(block)
 
@@ -166,26 +518,77 @@ class Node(object):
             mapping.update(child.get_name_node_map())
         return mapping
 
+    ## function Node.invalidate
+    ## Clears the cached URL and names of this node and everything that
+    ## depends on them. Call this after changing a node's name, type, children
+    ## or parent.
+    def invalidate(self):
+        self._url = None
+        self._short_name = None
+        self._full_name = None
+        for child in self.children:
+            child.invalidate()
+        # The parent's signature lists this node as a param.
+        if self.parent is not None:
+            self.parent._full_name = None
+
     def get_short_name(self):
-        return self.name.split('.')[-1]
+        if self._short_name is None:
+            self._short_name = self.name.split('.')[-1]
+        return self._short_name
 
     ## function Node.url
-    ## Gets the URL for this node.
+    ## Gets the URL for this node. It is computed once and cached until
+    ## @Node.invalidate is called.
     ##
     ## Returns:
     ##   {string}: The node's URL.
     def url(self):
-        url = self.name.lower().replace('.', '-')
-        if self.parent:
-            url = '%s-%s' % (self.parent.url(), url)
-        if self.top_level_type:
-            url = '%s-%s' % (self.top_level_type, url)
-        return url
-
-    def _get_signature_as_html(self):
+        if self._url is None:
+            url = self.name.lower().replace('.', '-')
+            if self.parent:
+                url = '%s-%s' % (self.parent.url(), url)
+            if self.top_level_type:
+                url = '%s-%s' % (self.top_level_type, url)
+            self._url = url
+        return self._url
+
+    ## function Node.get_references
+    ## Gets the "@Name" references in one of this node's fields.
+    ##
+    ## Params:
+    ##   field {string}: The field, one of "type", "default" and
+    ##     "return_type".
+    ##
+    ## Returns:
+    ##   {int[]}: The start and end of each reference in the field and its
+    ##     line number, one after the other.
+    def get_references(self, field):
+        if self.references is None:
+            return ()
+        for references_field, references in self.references:
+            if references_field == field:
+                return references
+        return ()
+
+    def _find_references(self, field, lineno):
+        text = getattr(self, field)
+        if text and '@' in text:
+            self.references = (self.references or ()) + (
+                (field, _find_references(text, lineno)),)
+
+    # The types are passed through text, which converts their code and links
+    # when rendering.
+    def _get_signature_as_html(self, text=None):
+        def convert(node, field):
+            value = getattr(node, field)
+            if text is None:
+                return value
+            return text(value, node.get_references(field))
+
         params = ', '.join([(OPTIONAL_FUNCTION_PARAM_HTML if
                 c.optional else FUNCTION_PARAM_HTML) % {
-            'type': c.top_level_type or c.type,
+            'type': c.top_level_type or convert(c, 'type'),
             'name': c.name
         } for c in self.children])
 
@@ -193,7 +596,7 @@ class Node(object):
             return FUNCTION_SIGNATURE_WITH_RETURN_HTML % {
                 'name': self.get_short_name(),
                 'params': params,
-                'return': self.return_type
+                'return': convert(self, 'return_type')
             }
 
         return FUNCTION_SIGNATURE_HTML % {
@@ -206,13 +609,27 @@ class Node(object):
         return type_.lower() == Node.FUNCTION
 
     def get_full_name(self):
+        if self._full_name is None:
+            if self._is_function():
+                self._full_name = self._get_signature_as_html()
+            else:
+                self._full_name = self.get_short_name()
+        return self._full_name
+
+    # The name in headings, which is the signature of a function. Most have
+    # no code or links, so the cached name is checked for them first.
+    def _get_name_html(self, out):
+        name = self.get_full_name()
+        if not out.converts() or ('@' not in name and '|' not in name):
+            return name
         if self._is_function():
-            return self._get_signature_as_html()
-        return self.get_short_name()
+            return self._get_signature_as_html(out.text)
+        return out.text(name)
 
-    def get_heading_html(self):
+    def get_heading_html(self, out=None):
         return FIRST_LEVEL_HTML % {
-            'name': self.get_full_name(),
+            'name': (self.get_full_name() if out is None else
+                     self._get_name_html(out)),
             'type': self.top_level_type,
             'url': self.url()
         }
@@ -226,48 +643,64 @@ class Node(object):
     ## Returns:
     ##   {string}: The HTML representation of this node.
     def to_html(self, no_heading=False):
+        out = _HtmlBuffer()
+        self._render(out, no_heading)
+        return out.getvalue()
+
+    # Converts the code and links in one of the node's fields.
+    def _get_field_html(self, out, field):
+        value = getattr(self, field)
+        if value is None or (self.references is None and '|' not in value):
+            return value
+        return out.text(value, self.get_references(field))
+
+    def _render(self, out, no_heading=False):
         html = []
-        name = self.get_full_name()
 
         if not no_heading:
+            name = self._get_name_html(out)
             if self.top_level_type is not None:
-                html.append((SECOND_LEVEL_HTML if self.type is None else
-                             SECOND_LEVEL_WITH_TYPE_HTML) % {
+                html.append((SECOND_LEVEL_HTML if self.type is None
+                             else SECOND_LEVEL_WITH_TYPE_HTML) % {
                     'name': name,
                     'url': self.url(),
-                    'type': self.type
+                    'type': self._get_field_html(out, 'type')
                 })
             else:
                 html.append(
                     (THIRD_LEVEL_HTML if self.default is None else
                         THIRD_LEVEL_DEFAULT_HTML) % {
                         'name': name,
-                        'type': self.type,
-                        'default': self.default,
+                        'type': self._get_field_html(out, 'type'),
+                        'default': self._get_field_html(out, 'default'),
                         'url': self.url(),
                         'optional_html': OPTIONAL_HTML if self.optional else ''
                     })
 
         if self.description:
-            html.append(self.description.to_html())
+            html.append(self.description.to_html(out))
 
         if self.children:
             title = self.params_text
             if self.top_level_type == Node.CLASS:
                 title = 'Constructor params:'
-            html.append(PARAM_LIST_HTML % {
+            if html:
+                out.write('\n'.join(html) + '\n')
+                html = []
+            _PARAM_LIST.render(out, {
                 'section': title,
-                'content': _indent_block(
-                    '\n'.join([PARAM_ITEM_HTML % _indent_block(p.to_html())
-                               for p in self.children]))
+                'content': lambda out: _render_lines(
+                    out, self.children, _render_param_item)
             })
+            if self.return_type:
+                out.write('\n')
 
         if self.return_type:
-            html.append(RETURN_HTML % self.return_type)
+            html.append(RETURN_HTML % self._get_field_html(out, 'return_type'))
             if self.return_description:
-                html.append(self.return_description.to_html())
+                html.append(self.return_description.to_html(out))
 
-        return '\n'.join(html)
+        out.write('\n'.join(html))
 
     def __repr__(self):
         return '%s: %s\nType %s, Default %s\nReturns %s: %s\nChildren: %s' % (
@@ -277,35 +710,34 @@ class Node(object):
 
     def _parse_return(self, block):
         # Pop off "Returns:" first.
-        block.pop(0)
+        block.popleft()
 
-        line = block[0]
-        block.pop(0)
+        line = block.popleft()
 
-        result = _parse_line([RETURN_RE], line.text)
-        if result is None:
+        match = _GRAMMAR.return_re.match(line.text)
+        if match is None:
             raise DocatronSyntaxError('bad return', self.filename, line.lineno)
 
-        groups, rest = result
+        groups, rest = _split_match(match, line.text)
 
         self.return_type = groups.get('type')
+        self._find_references('return_type', line.lineno)
         self.return_description = _Description(block, line.indent, rest,
                                                line.lineno)
 
-    def _parse_params(self, block):
-        line = block[0]
-        self.params_text = re.match(
-            PARAM_SECTION_RE,
-            line.text.lower()).group(0).strip().capitalize()
+    def _parse_params(self, block, match):
+        self.params_text = intern(match.group(0).strip().capitalize())
 
         # Pop off "Params:" first.
-        block.pop(0)
+        line = block.popleft()
 
         if not len(block):
             raise DocatronSyntaxError('params section needs at least one param',
                                       self.filename,
                                       line.lineno)
 
+        if not self.children:
+            self.children = []
         indent = block[0].indent
         while len(block):
             line = block[0]
@@ -316,29 +748,19 @@ class Node(object):
 
             self.children.append(Node(block, self.filename, self))
 
-    def _parse_param(self, block):
-        # Grab the line then pop it off.
-        line = block[0]
-        block.pop(0)
-
-        if _is_optional(line.text):
-            result = _parse_line([OPTIONAL_PARAM_DEFAULT_RE, OPTIONAL_PARAM_RE],
-                                 line.text)
-            self.optional = True
-        else:
-            result = _parse_line([PARAM_DEFAULT_RE, PARAM_RE], line.text)
-        if result is None:
-            raise DocatronSyntaxError('param malformed',
-                                      self.filename,
-                                      line.lineno)
+    def _parse_param(self, block, match, optional):
+        line = block.popleft()
 
-        groups, rest = result
-        self.type = groups.get('type', '')
+        self.optional = optional
+        groups, rest = _split_match(match, line.text)
+        self.type = intern(groups.get('type', ''))
         self.name = groups.get('name', '')
         self.default = groups.get('default')
         if self.default:
             # HACK: Replace escaped parens with normal parens.
             self.default = self.default.replace('\)', ')')
+        self._find_references('type', line.lineno)
+        self._find_references('default', line.lineno)
 
         self.description = _Description(block, line.indent, rest, line.lineno)
 
@@ -346,8 +768,7 @@ class Node(object):
             self._parse_block(block)
 
     def _parse_top_level(self, block):
-        line = block[0]
-        block.pop(0)
+        line = block.popleft()
 
         result = line.text.split()
         if len(result) < 2:
@@ -356,6 +777,7 @@ class Node(object):
                                       line.lineno)
 
         self.top_level_type, self.name = result[:2]
+        self.top_level_type = intern(self.top_level_type)
         if self.top_level_type not in Node.TOP_LEVEL_TYPES:
             raise DocatronSyntaxError(
                 'type must be one of: %s' % str(Node.TOP_LEVEL_TYPES),
@@ -363,13 +785,14 @@ class Node(object):
                 line.lineno)
 
         if self.top_level_type == Node.PROPERTY:
-            result = _parse_line([TYPE_RE], line.text)
-            if result is None:
+            match = _GRAMMAR.type_re.match(line.text)
+            if match is None:
                 raise DocatronSyntaxError('property must have a type',
                                           self.filename,
                                           line.lineno)
-            groups, _ = result
-            self.type = groups.get('type', '')
+            groups, _ = _split_match(match, line.text)
+            self.type = intern(groups.get('type', ''))
+            self._find_references('type', line.lineno)
 
         self.description = _Description(block, line.indent - 1, '', line.lineno)
 
@@ -388,11 +811,12 @@ class Node(object):
             line = block[0]
             if line.lineno != lineno and indent and line.indent <= indent:
                 break
-            if _is_params(line.text):
-                self._parse_params(block)
-            elif _is_param(line.text):
-                self._parse_param(block)
-            elif _is_return(line.text):
+            kind, match, optional = _GRAMMAR.classify(line.text)
+            if kind == Grammar.PARAMS:
+                self._parse_params(block, match)
+            elif kind == Grammar.PARAM:
+                self._parse_param(block, match, optional)
+            elif kind == Grammar.RETURN:
                 self._parse_return(block)
             else:
                 raise DocatronSyntaxError('no matches',
@@ -409,6 +833,8 @@ class Node(object):
 ##   filename {string}: The file this line belongs to.
 ##   lineno {int}: The line number in the file.
 class Line(object):
+    __slots__ = ('indent', 'lineno', 'text')
+
     def __init__(self, line, indent, filename, lineno):
         num_spaces = len(line) - len(line.lstrip())
         if num_spaces % indent:
@@ -439,18 +865,48 @@ class Line(object):
 ##   token ('///') {string}: The token that DOCATRON comments will start with.
 ##   indent (2) {int}: The indent that makes up one indent level for a DOCATRON
 ##     comment.
+##   [cache_dir] {string}: A directory to cache parsed files in. Files whose
+##     contents have not changed since the last run are not parsed again.
+##   jobs (1) {int}: The number of processes to parse files with. The
+##     results are merged in the order of the files parameter.
+##   [stats] {@BuildStats}: Collects timings for reading, scanning and parsing
+##     files.
+##   readers (0) {int}: The number of threads to read files ahead of the
+##     parser with, for file systems where opening a file is slow. Files are
+##     still parsed, and errors reported, in the order of the files parameter.
+##     With a cache_dir, files whose cache entry matches their modification
+##     time and size are not read. Not used when parsing with more than one
+##     job.
 class DocatronParser(object):
-    def __init__(self, files, token='///', indent=2):
+    def __init__(self, files, token='///', indent=2, cache_dir=None, jobs=1,
+                 stats=None, readers=0):
+        self._stats = stats or _NO_STATS
         self._token = token.strip()
         self._indent = indent
-        self._blocks = OrderedDict()
+        # Matches whole lines whose first non-whitespace text is the token,
+        # so ordinary code lines are skipped without being split or stripped.
+        self._token_re = re.compile(
+            r'^[ \t\r\x0b\x0c]*%s[^\n]*' % re.escape(self._token), re.M)
+        self._cache_dir = cache_dir
+        self._cache = None
+        if cache_dir is not None:
+            self._cache = ParseCache(cache_dir, self._token, indent)
         self._nodes = OrderedDict()
-        for name in files:
-            self._parse_file(name)
-        for filename, blocks in self._blocks.iteritems():
-            for block in blocks:
-                node = self._parse_block(block, filename)
-                self._nodes[node.name] = node
+        # List of (filename, nodes) in input order, so single files can be
+        # parsed again by update.
+        self._files = []
+
+        if jobs > 1:
+            # Workers do not report their phases, only the total.
+            with self._stats.phase('parallel parse'):
+                self._parse_files_parallel(files, jobs)
+        elif readers > 0:
+            for name, contents in _read_ahead(files, readers, self._stats,
+                                              self._read_ahead_file):
+                self._add_file(name, self._get_file_nodes(name, contents))
+        else:
+            for name in files:
+                self._add_file(name, self._get_file_nodes(name))
 
     ## function DocatronParser.get_nodes
     ## Gets the @Nodes parsed from the files passed to the parser.
@@ -460,37 +916,483 @@ class DocatronParser(object):
     def get_nodes(self):
         return self._nodes
 
-    def _has_token(self, line):
-        return line.strip().startswith(self._token)
+    ## function DocatronParser.get_files
+    ## Gets the files that were parsed, in the order they were given.
+    ##
+    ## Returns:
+    ##   {string[]}: The filenames.
+    def get_files(self):
+        return [name for name, _ in self._files]
+
+    ## function DocatronParser.get_parsed_files
+    ## Gets the @Nodes parsed from each file, e.g. to save them in a
+    ## @NodeFile.
+    ##
+    ## Returns:
+    ##   {tuple[]}: The filename and list of @Nodes of each file, in order.
+    def get_parsed_files(self):
+        return list(self._files)
+
+    ## function DocatronParser.add_parsed_files
+    ## Adds @Nodes parsed elsewhere, e.g. loaded from a @NodeFile, as if
+    ## their files had been parsed. They are cross-referenced with the other
+    ## nodes, and duplicates are errors as usual.
+    ##
+    ## Params:
+    ##   files {tuple[]}: The filename and list of @Nodes of each file, as
+    ##     returned by @DocatronParser.get_parsed_files.
+    def add_parsed_files(self, files):
+        for name, nodes in files:
+            self._add_file(name, nodes)
+
+    ## function DocatronParser.update
+    ## Parses some of the files again after they have changed, reusing the
+    ## @Nodes of every other file. If parsing fails, the previous @Nodes are
+    ## kept.
+    ##
+    ## Params:
+    ##   files {string[]}: The changed files.
+    ##   [all_files] {string[]}: Every file to parse, in order, when files have
+    ##     been added or removed. Files that were not parsed before are parsed,
+    ##     and the @Nodes of files that are no longer listed are dropped.
+    def update(self, files, all_files=None):
+        old_nodes, old_files = self._nodes, self._files
+        parsed = dict(old_files)
+        if all_files is None:
+            all_files = [name for name, _ in old_files]
+        for name in files:
+            parsed[name] = self._get_file_nodes(name)
+        for name in all_files:
+            if name not in parsed:
+                parsed[name] = self._get_file_nodes(name)
+
+        self._nodes = OrderedDict()
+        self._files = []
+        try:
+            for name in all_files:
+                self._add_file(name, parsed[name])
+        except:
+            self._nodes, self._files = old_nodes, old_files
+            raise
 
     def _strip_token(self, line):
         return line.strip()[len(self._token + ' '):]
 
-    def _parse_block(self, block, filename):
-        node = Node(block, filename, None)
+    def _add_file(self, filename, nodes):
+        self._files.append((filename, nodes))
+        for node in nodes:
+            self._add_node(node)
+
+    def _add_node(self, node):
         prev_node = self._nodes.get(node.name)
         if prev_node is not None:
             raise DocatronSyntaxError(
                 'duplicate nodes: found here first: %s line %s' %
                     (prev_node.filename, prev_node.lineno),
-                filename,
+                node.filename,
                 node.lineno)
-        return node
+        self._nodes[node.name] = node
+
+    def _parse_files_parallel(self, files, jobs):
+        files = list(files)
+        pool = multiprocessing.Pool(
+            jobs, _init_parse_worker,
+            (self._token, self._indent, self._cache_dir))
+        try:
+            # imap yields in input order, so duplicates and errors are
+            # reported just as they would be by a single process.
+            results = pool.imap(_parse_worker_file, files,
+                                max(1, len(files) / (jobs * 4)))
+            for name, nodes in izip(files, results):
+                self._add_file(name, nodes)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    # Contents may be passed in when the file has already been read.
+    def _get_file_nodes(self, filename, contents=None):
+        start = time.time()
+        nodes = self._load_file_nodes(filename, contents)
+        self._stats.add_file(filename, time.time() - start, len(nodes))
+        return nodes
+
+    def _read_file(self, filename):
+        with self._stats.phase('read'):
+            return _read_contents(filename)
+
+    # Reads a file for _read_ahead, or returns None without reading it when
+    # its cache entry matches on stat, since the cache would not use it.
+    def _read_ahead_file(self, filename):
+        if (self._cache is not None and
+                self._cache.load_stat(filename) == _get_stat(filename)):
+            return None
+        return _read_contents(filename)
+
+    def _load_file_nodes(self, filename, contents=None):
+        if self._cache is None:
+            if contents is None:
+                contents = self._read_file(filename)
+            return self._parse_file(contents, filename)
+
+        stat = os.stat(filename)
+        stat = (stat.st_mtime, stat.st_size)
+        with self._stats.phase('cache'):
+            entry = self._cache.load(filename)
+        if entry is not None and entry['stat'] == stat:
+            return entry['nodes']
+
+        if contents is None:
+            contents = self._read_file(filename)
+        digest = hashlib.sha1(contents).hexdigest()
+        if entry is not None and entry['digest'] == digest:
+            nodes = entry['nodes']
+        else:
+            nodes = self._parse_file(contents, filename)
+        with self._stats.phase('cache'):
+            self._cache.store(filename, stat, digest, nodes)
+        return nodes
+
+    # Each block is parsed into a Node as soon as it is scanned, and Node
+    # consumes its Lines as it goes, so only one block of Lines is alive at a
+    # time instead of every block in the file. Scanning and parsing are timed
+    # around each block and added to the stats once per file.
+    def _parse_file(self, contents, filename):
+        nodes = []
+        scan_seconds = parse_seconds = 0.0
+        start = time.time()
+        for block in self._scan_blocks(contents, filename):
+            scanned = time.time()
+            scan_seconds += scanned - start
+            nodes.append(Node(block, filename, None))
+            start = time.time()
+            parse_seconds += start - scanned
+        scan_seconds += time.time() - start
+
+        self._stats.add_phase('scan', scan_seconds)
+        self._stats.add_phase('parse', parse_seconds, len(nodes))
+        return nodes
+
+    # Yields a deque of @Lines for each block of DOCATRON comments. A block is
+    # ended by the first line without the token, so a block at the very end of
+    # a file is not yielded.
+    def _scan_blocks(self, contents, filename):
+        current_block = deque()
+        lineno = 1
+        prev_lineno = 0
+        pos = end = 0
+        for match in self._token_re.finditer(contents):
+            lineno += contents.count('\n', pos, match.start())
+            pos, end = match.span()
+            # Some line without the token came between this and the last one.
+            if current_block and lineno > prev_lineno + 1:
+                yield current_block
+                current_block = deque()
+            prev_lineno = lineno
+
+            line = self._strip_token(match.group(0))
+            if line:
+                current_block.append(Line(line, self._indent, filename, lineno))
+
+        if current_block and len(contents) > end + 1:
+            yield current_block
+
+
+def _read_contents(filename):
+    with open(filename) as f:
+        return f.read()
+
+
+# Yields (filename, read(filename)) in the order of files, reading up to twice
+# as many files ahead as there are threads. An error reading a file is raised
+# when that file is reached, as if it had been read in order. Only the time
+# spent waiting for contents counts as reading in the stats.
+def _read_ahead(files, threads, stats, read=_read_contents):
+    pool = ThreadPool(threads)
+    pending = deque()
+
+    def next_file():
+        name, result = pending.popleft()
+        with stats.phase('read'):
+            return name, result.get()
+
+    try:
+        for name in files:
+            pending.append((name, pool.apply_async(read, (name,))))
+            if len(pending) > threads * 2:
+                yield next_file()
+        while pending:
+            yield next_file()
+    finally:
+        pool.terminate()
+        pool.join()
 
-    def _parse_file(self, filename):
-        current_block = []
-        with open(filename) as f:
-            for i, line in enumerate(f):
-                if self._has_token(line):
-                    line = self._strip_token(line)
-                    if line:
-                        current_block.append(
-                            Line(line, self._indent, filename, i + 1))
-                elif current_block:
-                    if not filename in self._blocks:
-                        self._blocks[filename] = []
-                    self._blocks[filename].append(current_block)
-                    current_block = []
+
+_worker_parser = None
+
+
+def _init_parse_worker(token, indent, cache_dir):
+    global _worker_parser
+    _worker_parser = DocatronParser([], token=token, indent=indent,
+                                    cache_dir=cache_dir)
+
+
+def _parse_worker_file(filename):
+    return _worker_parser._get_file_nodes(filename)
+
+
+## class ParseCache
+## An on-disk cache of the @Nodes parsed from each file, used by
+## @DocatronParser. Entries are keyed on the file's path and store its
+## modification time, size and a hash of its contents. These are stored ahead
+## of the @Nodes, so they can be checked without loading the @Nodes.
+##
+## Params:
+##   directory {string}: The directory to keep cache entries in.
+##   token {string}: The token DOCATRON comments start with.
+##   indent {int}: The indent that makes up one indent level.
+class ParseCache(object):
+    VERSION = 5
+
+    def __init__(self, directory, token, indent):
+        self._directory = directory
+        self._settings = (ParseCache.VERSION, token, indent)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _get_path(self, filename):
+        return os.path.join(
+            self._directory,
+            hashlib.sha1(os.path.abspath(filename)).hexdigest())
+
+    ## function ParseCache.load
+    ## Loads the cache entry for a file.
+    ##
+    ## Params:
+    ##   filename {string}: The file to load the entry for.
+    ##
+    ## Returns:
+    ##   {dict}: The entry, or None if there is no usable entry.
+    def load(self, filename):
+        return self._load(filename, True)
+
+    ## function ParseCache.load_stat
+    ## Loads the modification time and size stored for a file, without its
+    ## @Nodes.
+    ##
+    ## Params:
+    ##   filename {string}: The file to load the stat for.
+    ##
+    ## Returns:
+    ##   {tuple}: The modification time and size, or None if there is no
+    ##     usable entry.
+    def load_stat(self, filename):
+        entry = self._load(filename, False)
+        return entry and entry['stat']
+
+    def _load(self, filename, nodes):
+        try:
+            with open(self._get_path(filename), 'rb') as f:
+                entry = cPickle.load(f)
+                if (entry.get('settings') != self._settings or
+                        entry.get('filename') != os.path.abspath(filename)):
+                    return None
+                if nodes:
+                    entry['nodes'] = cPickle.load(f)
+        except Exception:
+            # Missing, truncated or otherwise unreadable entries are misses.
+            return None
+        return entry
+
+    ## function ParseCache.store
+    ## Stores the cache entry for a file.
+    ##
+    ## Params:
+    ##   filename {string}: The file the entry is for.
+    ##   stat {tuple}: The file's modification time and size.
+    ##   digest {string}: A hash of the file's contents.
+    ##   nodes {@Node[]}: The nodes parsed from the file.
+    def store(self, filename, stat, digest, nodes):
+        path = self._get_path(filename)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump({
+                'settings': self._settings,
+                'filename': os.path.abspath(filename),
+                'stat': stat,
+                'digest': digest
+            }, f, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(nodes, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+
+
+# Converts a @Node and its children to tuples that marshal can store. The
+# filename is stored once per file instead of on every node.
+def _node_to_tuple(node):
+    return (node.name, node.lineno,
+            tuple([_node_to_tuple(c) for c in node.children]),
+            node.return_type, _description_to_tuple(node.return_description),
+            node.default, _description_to_tuple(node.description),
+            node.type, node.top_level_type, node.params_text, node.optional,
+            node.references)
+
+
+def _description_to_tuple(description):
+    if description is None:
+        return None
+    return description.description, description.references
+
+
+def _description_from_tuple(values):
+    if values is None:
+        return None
+    result = _Description.__new__(_Description)
+    result.description, result.references = values
+    return result
+
+
+# Builds a @Node from _node_to_tuple without parsing anything again.
+def _node_from_tuple(values, filename, parent):
+    node = Node.__new__(Node)
+    (node.name, node.lineno, children, node.return_type, return_description,
+     node.default, description, node.type, node.top_level_type,
+     node.params_text, node.optional, node.references) = values
+    node.filename = filename
+    node.parent = parent
+    node.return_description = _description_from_tuple(return_description)
+    node.description = _description_from_tuple(description)
+    node.children = ()
+    if children:
+        node.children = [_node_from_tuple(c, filename, node)
+                         for c in children]
+    node._url = None
+    node._short_name = None
+    node._full_name = None
+    return node
+
+
+## class NodeFile
+## A compact file of the @Nodes parsed from a set of files. The parse command
+## writes one and the render command merges any number of them, so parsing
+## can be split across machines. It is stored with marshal and versioned,
+## and files from another version are rejected.
+##
+## Params:
+##   filename {string}: The file to read or write.
+class NodeFile(object):
+    MAGIC = 'docatron-nodes'
+    VERSION = 2
+
+    def __init__(self, filename):
+        self._filename = filename
+
+    ## function NodeFile.write
+    ## Writes the @Nodes of each file.
+    ##
+    ## Params:
+    ##   files {tuple[]}: The filename and list of @Nodes of each file, as
+    ##     returned by @DocatronParser.get_parsed_files.
+    def write(self, files):
+        data = (NodeFile.MAGIC, NodeFile.VERSION,
+                tuple([(name, tuple([_node_to_tuple(n) for n in nodes]))
+                       for name, nodes in files]))
+        tmp_filename = '%s.%d.tmp' % (self._filename, os.getpid())
+        with open(tmp_filename, 'wb') as f:
+            marshal.dump(data, f, 2)
+        os.rename(tmp_filename, self._filename)
+
+    ## function NodeFile.read
+    ## Reads the @Nodes of each file.
+    ##
+    ## Returns:
+    ##   {tuple[]}: The filename and list of @Nodes of each file, for
+    ##     @DocatronParser.add_parsed_files.
+    def read(self):
+        with open(self._filename, 'rb') as f:
+            try:
+                data = marshal.load(f)
+            except (EOFError, ValueError, TypeError):
+                data = None
+
+        if (not isinstance(data, tuple) or len(data) != 3 or
+                data[0] != NodeFile.MAGIC):
+            raise IOError('%s: not a DOCATRON node file' % self._filename)
+        if data[1] != NodeFile.VERSION:
+            raise IOError('%s: unsupported node file version %s' %
+                          (self._filename, data[1]))
+        return [(name, [_node_from_tuple(n, name, None) for n in nodes])
+                for name, nodes in data[2]]
+
+
+## class SymbolDatabase
+## The symbol table of a build, stored as an SQLite database. Builds export
+## one with @DocatronWriter.export_symbols, and other builds pass it to
+## @DocatronWriter to link to those symbols without parsing their sources.
+##
+## Params:
+##   filename {string}: The database file.
+class SymbolDatabase(object):
+    VERSION = 1
+
+    def __init__(self, filename):
+        self._filename = filename
+
+    ## function SymbolDatabase.write
+    ## Replaces the database with a new set of symbols.
+    ##
+    ## Params:
+    ##   symbols {tuple[]}: The (name, type, page, url, parent_url) of each
+    ##     symbol.
+    ##   [base_url] {string}: Prefixed to the page of every symbol.
+    def write(self, symbols, base_url=''):
+        tmp_filename = '%s.%d.tmp' % (self._filename, os.getpid())
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        conn = sqlite3.connect(tmp_filename)
+        try:
+            conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+            conn.execute('CREATE TABLE symbols (name TEXT PRIMARY KEY, '
+                         'type TEXT, page TEXT, url TEXT, parent_url TEXT)')
+            conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+                ('version', str(SymbolDatabase.VERSION)),
+                ('base_url', base_url)
+            ])
+            conn.executemany('INSERT INTO symbols VALUES (?, ?, ?, ?, ?)',
+                             symbols)
+            conn.commit()
+        finally:
+            conn.close()
+        os.rename(tmp_filename, self._filename)
+
+    ## function SymbolDatabase.read
+    ## Reads all the symbols in the database.
+    ##
+    ## Returns:
+    ##   {dict}: Maps each name to its (page, url, parent_url), with the base
+    ##     URL already prefixed to the page.
+    def read(self):
+        # Connecting would create a missing database.
+        if not os.path.isfile(self._filename):
+            raise IOError('%s: no such symbol database' % self._filename)
+
+        conn = sqlite3.connect(self._filename)
+        conn.text_factory = str
+        try:
+            meta = dict(conn.execute('SELECT key, value FROM meta'))
+            if meta.get('version') != str(SymbolDatabase.VERSION):
+                raise IOError('%s: unsupported symbol database version %s' %
+                              (self._filename, meta.get('version')))
+            base_url = meta['base_url']
+            return dict([
+                (name, (base_url + page, url, parent_url))
+                for name, page, url, parent_url in conn.execute(
+                    'SELECT name, page, url, parent_url FROM symbols')])
+        except sqlite3.DatabaseError as e:
+            raise IOError('%s: %s' % (self._filename, e))
+        finally:
+            conn.close()
 
 
 ## class WriterNode
@@ -499,9 +1401,14 @@ class DocatronParser(object):
 ## Params:
 ##   node {@Node}: The @Node this wraps.
 class WriterNode(object):
+    __slots__ = ('node', 'children')
+
+    # Shared by every node without children. add_child replaces it.
+    _NO_CHILDREN = OrderedDict()
+
     def __init__(self, node):
         self.node = node
-        self.children = OrderedDict([(t, []) for t in Node.TOP_LEVEL_TYPES])
+        self.children = WriterNode._NO_CHILDREN
 
     ## function WriterNode.add_child
     ## Adds a child to this node (e.g. a function that belongs to the class).
@@ -509,6 +1416,9 @@ class WriterNode(object):
     ## Params:
     ##   child {@WriterNode}: The child to add.
     def add_child(self, child):
+        if self.children is WriterNode._NO_CHILDREN:
+            self.children = OrderedDict([(t, [])
+                                         for t in Node.TOP_LEVEL_TYPES])
         self.children[child.node.top_level_type].append(child)
 
     ## function WriterNode.to_html
@@ -520,36 +1430,83 @@ class WriterNode(object):
     ## Returns:
     ##   {string}: This node as HTML.
     def to_html(self, top_level=False):
-        if top_level:
-            heading = self.node.get_heading_html()
-        html = [self.node.to_html(no_heading=top_level)]
+        out = _HtmlBuffer()
+        self._render(out, top_level)
+        return out.getvalue()
+
+    def _render(self, out, top_level=False):
+        if not top_level:
+            self._render_content(out, False)
+            return
+
+        out.write(self.node.get_heading_html(out) + '\n')
+        _FIRST_LEVEL_CONTAINER.render(out, {
+            'url': self.node.url(),
+            'content': lambda out: self._render_content(out, True)
+        })
+
+    def _render_content(self, out, top_level):
+        self.node._render(out, no_heading=top_level)
 
         for section, children in self.children.iteritems():
             if not children:
                 continue
-            html.append(PROPERTY_LIST_HTML % {
+            out.write('\n')
+            _PROPERTY_LIST.render(out, {
                 'section': Node.section_to_str(section) + ':',
-                'content': _indent_block(
-                    '\n'.join([PARAM_ITEM_HTML % _indent_block(child.to_html())
-                               for child in children]))
+                'content': lambda out: _render_lines(
+                    out, children, _render_param_item)
             })
 
-        if top_level:
-            return '%s\n%s' % (heading,
-                FIRST_LEVEL_CONTAINER_HTML % {
-                    'url': self.node.url(),
-                    'content': _indent_block('\n'.join(html))
-                })
-        return '\n'.join(html)
-
 
 ## class DocatronWriter
 ## Writes a DOCATRON document to HTML.
 ##
 ## Params:
 ##   nodes {@Node[]}: A list of nodes from @DocatronParser.get_nodes.
+##   [stats] {@BuildStats}: Collects timings for building the tree, rendering
+##     and linking.
+##   [symbols] {@SymbolDatabase[]}: Symbols exported by other builds. "@Name"
+##     links to them when there is no node with that name.
+##   collapsed_toc (False) {boolean}: Whether the table of contents only lists
+##     the top level items. The child list of each item is written to a JSON
+##     fragment in the TOC_FRAGMENTS directory and loaded when the item is
+##     first clicked.
 class DocatronWriter(object):
-    def __init__(self, nodes):
+    INDEX_PAGE = 'index.html'
+    MANIFEST = 'manifest.json'
+    SEARCH_PREFIX_LENGTH = 12
+    TOC_FRAGMENTS = 'toc'
+
+    def __init__(self, nodes, stats=None, symbols=None, collapsed_toc=False):
+        self._stats = stats or _NO_STATS
+        self._collapsed_toc = collapsed_toc
+        with self._stats.phase('tree'):
+            self._build_tree(nodes)
+
+        # Maps names from other builds to their (page, url, parent_url). The
+        # first database with a name wins.
+        self._external_symbols = {}
+        if symbols:
+            with self._stats.phase('symbols'):
+                for database in reversed(symbols):
+                    self._external_symbols.update(database.read())
+
+        # Built by _get_link_index when it is first needed.
+        self._link_index = None
+        # Maps the run after each "@" to the name it links to, from
+        # _get_link. It is not keyed on the page, so it only grows with the
+        # references in the document, however many pages are rendered.
+        self._links = {}
+        # The time spent looking up links while rendering, which is counted
+        # as the link phase instead of the render phase.
+        self._link_seconds = 0.0
+        self._node_pages = None
+        self._page_nodes = None
+        self._fragment_nodes = None
+        self._writer_nodes = None
+
+    def _build_tree(self, nodes):
         # Turn the Nodes into WriterNodes.
         self._nodes = OrderedDict([(k, WriterNode(v))
                                    for k, v in nodes.iteritems()])
@@ -558,15 +1515,13 @@ class DocatronWriter(object):
         for node in nodes.values():
             self._name_node_map.update(node.get_name_node_map())
 
-        names = self._nodes.keys()
+        names = set(self._nodes)
         added = []
-        for name in names:
-            parents = [n for n in names if name.startswith('%s.' % n)]
-            if not parents:
+        for name in self._nodes:
+            parent = _get_parent_name(name, names)
+            if parent is None:
                 continue
 
-            max_length = max(map(len, parents))
-            parent = [p for p in parents if len(p) == max_length][0]
             self._nodes[parent].add_child(self._nodes[name])
             added.append(name)
 
@@ -579,87 +1534,1548 @@ class DocatronWriter(object):
     ##
     ## Params:
     ##   html {string}: The HTML to convert links in.
+    ##   [page] {string}: The page the HTML is on when writing one page per top
+    ##     level item. Links to items on other pages include the page.
     ##
     ## Returns:
     ##   {string}: The HTML with links.
-    def create_links(self, html):
-        names = sorted(self._name_node_map.keys(), key=len, reverse=True)
+    def create_links(self, html, page=None):
+        if '@' not in html:
+            return html
+        links = self._get_links(html, _find_references(html, None), page)
+        return _replace(html, links, 0, len(html))
+
+    # Looks up the references found in text when it was parsed. Returns the
+    # start and end in text of each one that is a link and its HTML.
+    def _get_links(self, text, references, page):
+        links = []
+        for i in xrange(0, len(references), 3):
+            start = references[i]
+            # The two characters after the reference are for the boundary
+            # check, and whitespace, "@" or "|" end the reference, so the
+            # run is enough to look it up.
+            run = text[start + 1:references[i + 1] + 2]
+            link = self._links.get(run)
+            if link is None:
+                link = self._get_link(run, references[i + 1] - start - 1)
+            if link:
+                name, end = link
+                links.append((start, start + 1 + end,
+                              self._get_link_html(name, run[:end], page)))
+        return links
+
+    # Looks up the run after an "@", where the reference is the first length
+    # characters. Returns the name and its end in the run, or an empty tuple
+    # if it is not a link.
+    def _get_link(self, run, length):
+        link = self._match_run(run, length) or ()
+        self._links[run] = link
+        return link
+
+    # Matches the start of text, where the first longest characters are the
+    # run after an "@". The longest name wins, optionally followed by an "s",
+    # and it must end at a word boundary. Returns the name and the end of the
+    # match, or None.
+    def _match_run(self, text, longest):
+        for length in self._get_link_index()[0]:
+            if length > longest:
+                continue
+            name = text[:length]
+            if (name not in self._name_node_map and
+                    name not in self._external_symbols):
+                continue
+            if text[length:length + 1] == 's' and _is_word_boundary(
+                    text, length + 1):
+                return name, length + 1
+            if _is_word_boundary(text, length):
+                return name, length
+        return None
+
+    # Returns the lengths of all the names that can be linked to, longest
+    # first, and the characters used in them.
+    def _get_link_index(self):
+        if self._link_index is None:
+            lengths = set()
+            chars = set()
+            for names in (self._name_node_map, self._external_symbols):
+                for name in names:
+                    lengths.add(len(name))
+                    chars.update(name)
+            self._link_index = (sorted(lengths, reverse=True),
+                                frozenset(chars))
+        return self._link_index
+
+    def _get_link_html(self, name, text, page):
+        node = self._name_node_map.get(name)
+        if node is None:
+            node_page, url, parent_url = self._external_symbols[name]
+            return PAGE_LINK_HTML % {
+                'page': node_page,
+                'url': url,
+                'name': text,
+                'parent_url': parent_url
+            }
 
-        for name in names:
-            def sub_link(match):
-                return LINK_HTML % {
-                    'url': self._name_node_map[name].url(),
-                    'name': match.group(1),
-                    'parent_url': self._name_node_map[name.split('.')[0]].url()
-                }
-
-            html = re.sub(r'@(%ss?)\b' % re.escape(name), sub_link, html)
-        return html
+        values = {
+            'url': node.url(),
+            'name': text,
+            'parent_url': self._get_parent_url(name, node)
+        }
+        node_page = self._get_node_pages()[node] if page else None
+        if node_page is None or node_page == page:
+            return LINK_HTML % values
+        values['page'] = node_page
+        return PAGE_LINK_HTML % values
+
+    ## function DocatronWriter.get_unresolved_links
+    ## Finds "@Name" references that do not match any node or imported
+    ## symbol. Examples are not checked, and neither is an "@" after a word
+    ## character, as in an email address.
+    ##
+    ## Returns:
+    ##   {tuple[]}: The filename, line number and name of each reference, in
+    ##     the order they appear in the document.
+    def get_unresolved_links(self):
+        unresolved = []
+        for _, writer_node in self._iter_writer_nodes():
+            item = []
+            nodes = [writer_node.node]
+            while nodes:
+                node = nodes.pop()
+                for text, references in self._get_link_texts(node):
+                    for start, end, lineno in _iter_references(references):
+                        name = self._get_unresolved_name(text, start, end)
+                        if name is not None:
+                            item.append((node.filename, lineno, name))
+                nodes.extend(reversed(node.children))
+            # An item and its params are all in one file.
+            unresolved.extend(sorted(item, key=lambda link: link[1]))
+        return unresolved
+
+    # The name referenced by the "@" at start of text, or None if it is a
+    # link or not a reference. The name is the run of word characters, "$",
+    # "." and characters used in names, like "-", after the "@".
+    def _get_unresolved_name(self, text, start, end):
+        if ((start and text[start - 1] in _WORD_CHARS) or
+                text[start + 1:start + 2] not in _REFERENCE_START_CHARS):
+            return None
+        run = text[start + 1:end + 2]
+        if self._match_run(run, end - start - 1) is not None:
+            return None
+        chars = self._get_link_index()[1]
+        length = 0
+        while length < end - start - 1 and (run[length] in chars or
+                                            run[length] in _NAME_CHARS):
+            length += 1
+        return run[:length].rstrip('.')
+
+    # The text of a node that may contain links and the references in it.
+    def _get_link_texts(self, node):
+        texts = [(getattr(node, field), node.get_references(field))
+                 for field in ('type', 'default', 'return_type')]
+        for description in (node.description, node.return_description):
+            if description:
+                texts.extend([(text, references) for is_example, text,
+                              references in description.iter_texts()
+                              if not is_example])
+        return [(text, references) for text, references in texts
+                if references]
+
+    # Converts the code and links in text from a DOCATRON comment, with the
+    # references found in it when it was parsed. References cannot contain
+    # the "|" around code, so each is either in code or outside of it.
+    def _convert(self, page, text, references):
+        if not references:
+            return self.sub_code(text)
+        start = time.time()
+        links = self._get_links(text, references, page)
+        self._link_seconds += time.time() - start
+        if not links:
+            return self.sub_code(text)
+        if '|' not in text:
+            return _replace(text, links, 0, len(text))
+
+        parts = []
+        start = 0
+        for match in _GRAMMAR.code_re.finditer(text):
+            parts.append(_replace(text, links, start, match.start()))
+            parts.append(CODE_HTML % _replace(text, links, match.start(1),
+                                              match.end(1)))
+            start = match.end()
+        parts.append(_replace(text, links, start, len(text)))
+        return ''.join(parts)
+
+    ## function DocatronWriter.export_symbols
+    ## Exports the names, types and URLs of the documented items, so other
+    ## builds can link to them. Params are not exported.
+    ##
+    ## Params:
+    ##   database {@SymbolDatabase}: The database to write.
+    ##   [base_url] {string}: Where the docs are published. This is the page
+    ##     itself for a single page, or the directory, ending in "/", for
+    ##     @DocatronWriter.write_pages.
+    ##   pages (False) {boolean}: Whether the docs were written one page per
+    ##     top level item.
+    def export_symbols(self, database, base_url='', pages=False):
+        symbols = []
+        for name, node in self._name_node_map.iteritems():
+            if node.top_level_type is None:
+                continue
+            symbols.append((
+                name,
+                node.top_level_type,
+                self._get_node_pages()[node] if pages else '',
+                node.url(),
+                self._get_parent_url(name, node)))
+        database.write(sorted(symbols), base_url)
+
+    # The URL of the item a name's first part names. A dotted name whose
+    # first part is not documented, like "util.helper", is its own parent.
+    def _get_parent_url(self, name, node):
+        return self._name_node_map.get(name.split('.')[0], node).url()
 
     def sub_code(self, html):
-        return re.sub(CODE_RE, lambda m: CODE_HTML % m.group(1), html)
+        if '|' not in html:
+            return html
+        return _GRAMMAR.code_re.sub(lambda m: CODE_HTML % m.group(1), html)
 
     ## function DocatronWriter.get_table_of_contents
     ## Creates the table of contents.
     ##
+    ## Params:
+    ##   pages (False) {boolean}: Whether the links should point to the page of
+    ##     each top level item, as written by @DocatronWriter.write_pages.
+    ##
     ## Returns:
     ##   {string}: The table of contents as HTML.
-    def get_table_of_contents(self):
-        toc = []
-
-        def create_link(writer_node, parent=None):
-            return (LINK_TOC if parent else TOP_LEVEL_LINK_TOC) % {
-                'name': writer_node.node.get_short_name(),
-                'url': writer_node.node.url(),
-                'parent_url': parent.node.url() if parent else None
-            }
+    def get_table_of_contents(self, pages=False):
+        out = _HtmlBuffer()
+        self._render_table_of_contents(out, pages)
+        return out.getvalue()
+
+    def _render_table_of_contents(self, out, pages):
+        template = _COLLAPSED_BASE_TOC if self._collapsed_toc else _BASE_TOC
+        template.render(out, {
+            '': lambda out: self._write_items(out, self._get_toc_items(pages))
+        })
+
+    def _get_toc_items(self, pages=False):
+        for node in self._nodes.values():
+            with self._stats.phase('toc'):
+                link = self._create_toc_link(node, None, pages)
+                if not self._collapsed_toc:
+                    item = FIRST_LEVEL_TOC % (
+                        link + self._get_toc_children(node, pages))
+                elif self._has_toc_children(node):
+                    item = COLLAPSED_FIRST_LEVEL_TOC % {
+                        'link': link,
+                        'children': self._get_toc_fragment(node)
+                    }
+                else:
+                    item = FIRST_LEVEL_TOC % link
+
+            yield item
+
+    def _create_toc_link(self, writer_node, parent, pages):
+        values = {
+            'name': writer_node.node.get_short_name(),
+            'url': writer_node.node.url(),
+            'parent_url': parent.node.url() if parent else None
+        }
+        if not pages:
+            html = (LINK_TOC if parent else TOP_LEVEL_LINK_TOC) % values
+        else:
+            values['page'] = self._get_node_pages()[writer_node.node]
+            html = (PAGE_LINK_TOC if parent else
+                    PAGE_TOP_LEVEL_LINK_TOC) % values
+        return self.sub_code(html)
+
+    # The child lists of a top level item in the TOC, in the order of
+    # WriterNode.children, or an empty string if it has no children.
+    def _get_toc_children(self, node, pages):
+        html = ''
+        for section, children in node.children.iteritems():
+            if children:
+                section_toc = '%s\n%s' % (
+                    SECTION_TITLE % Node.section_to_str(section),
+                    '\n'.join([SECOND_LEVEL_TOC %
+                               self._create_toc_link(c, node, pages)
+                               for c in children]))
+                html += SECOND_BASE_TOC % section_toc
+        return html
 
+    def _has_toc_children(self, node):
+        return any(node.children.itervalues())
+
+    # Named after the item's page, which is unique.
+    def _get_toc_fragment(self, node):
+        page = self._get_node_pages()[node.node]
+        return '%s/%s.json' % (DocatronWriter.TOC_FRAGMENTS,
+                               os.path.splitext(page)[0])
+
+    def _get_fragment_nodes(self):
+        if self._fragment_nodes is None:
+            self._fragment_nodes = OrderedDict()
+            if self._collapsed_toc:
+                for node in self._nodes.values():
+                    if self._has_toc_children(node):
+                        fragment = self._get_toc_fragment(node)
+                        self._fragment_nodes[fragment] = node
+        return self._fragment_nodes
+
+    ## function DocatronWriter.get_toc_fragments
+    ## Gets the JSON fragments of a collapsed table of contents.
+    ##
+    ## Returns:
+    ##   {string[]}: The path of each fragment, relative to the output
+    ##     directory, or an empty list if the table of contents is not
+    ##     collapsed.
+    def get_toc_fragments(self):
+        return self._get_fragment_nodes().keys()
+
+    ## function DocatronWriter.render_toc_fragment
+    ## Renders the child lists of a top level item for a collapsed table of
+    ## contents, as compact JSON with the HTML in "html".
+    ##
+    ## Params:
+    ##   fragment {string}: One of the fragments from
+    ##     @DocatronWriter.get_toc_fragments.
+    ##   pages (False) {boolean}: Whether the links should point to the page of
+    ##     each top level item, as written by @DocatronWriter.write_pages.
+    ##
+    ## Returns:
+    ##   {string}: The fragment as JSON, or None if there is no such fragment.
+    def render_toc_fragment(self, fragment, pages=False):
+        node = self._get_fragment_nodes().get(fragment)
+        if node is None:
+            return None
+        with self._stats.phase('toc'):
+            return json.dumps({'html': self._get_toc_children(node, pages)},
+                              separators=(',', ':'))
+
+    ## function DocatronWriter.write_toc_fragments
+    ## Writes the JSON fragments of a collapsed table of contents for the
+    ## output of @DocatronWriter.write_html. Their content hashes are added to
+    ## the manifest in the directory, which may be shared with other outputs,
+    ## and fragments whose content has not changed are not written again.
+    ## Fragments of items that no longer have children are removed, with their
+    ## manifest entries, as are all fragments once the table of contents is no
+    ## longer collapsed.
+    ## @DocatronWriter.write_pages writes its own fragments.
+    ##
+    ## Params:
+    ##   directory {string}: The directory the HTML is written to.
+    ##   compress (False) {boolean}: Whether to also write compressed copies
+    ##     of every fragment, as @ArtifactFile does.
+    ##
+    ## Returns:
+    ##   {string[]}: The fragments that were written.
+    def write_toc_fragments(self, directory, compress=False):
+        fragments = self.get_toc_fragments()
+        fragments_dir = os.path.join(directory, DocatronWriter.TOC_FRAGMENTS)
+        if not fragments and not os.path.isdir(fragments_dir):
+            return []
+
+        manifest_path = os.path.join(directory, DocatronWriter.MANIFEST)
+        hashes = _read_manifest(manifest_path)
+        written = []
+        for fragment in fragments:
+            json_text = self.render_toc_fragment(fragment)
+            write = lambda f: f.write(json_text)
+            if _write_artifact(directory, fragment, write, compress, hashes,
+                               hashes):
+                written.append(fragment)
+
+        # Compressed copies are stale too once compression is turned off.
+        # Manifest entries are checked as well, in case their files are gone.
+        prefix = DocatronWriter.TOC_FRAGMENTS + '/'
+        fragments = set(fragments)
+        for fragment in set([prefix + name
+                             for name in os.listdir(fragments_dir)] +
+                            [name for name in hashes
+                             if name.startswith(prefix)]):
+            base, extension = os.path.splitext(fragment)
+            if extension not in ArtifactFile.EXTENSIONS:
+                base, extension = fragment, ''
+            if (base.endswith('.json') and
+                    (base not in fragments or extension and not compress)):
+                path = os.path.join(directory, fragment)
+                if os.path.exists(path):
+                    os.remove(path)
+                hashes.pop(fragment, None)
+        if not os.listdir(fragments_dir):
+            os.rmdir(fragments_dir)
+        _write_manifest(manifest_path, hashes)
+        return written
+
+    def _get_content_items(self):
         for node in self._nodes.values():
-            item = create_link(node)
-            for section, children in node.children.iteritems():
-                if children:
-                    section_toc = '%s\n%s' % (
-                        SECTION_TITLE % Node.section_to_str(section),
-                        '\n'.join([SECOND_LEVEL_TOC % create_link(c, node)
-                                   for c in children]))
-                    item += SECOND_BASE_TOC % section_toc
+            yield self._get_item_html(node)
+
+    def _get_item_html(self, node, page=None):
+        start = time.time()
+        link_seconds = self._link_seconds
+        out = _HtmlBuffer(functools.partial(self._convert, page))
+        _BASE_ITEM.render(out, {
+            '': lambda out: node._render(out, top_level=True)
+        })
+        html = out.getvalue()
+        link_seconds = self._link_seconds - link_seconds
+        self._stats.add_phase('render', time.time() - start - link_seconds)
+        self._stats.add_phase('link', link_seconds)
+        self._stats.add_item(node.node.name, len(html))
+        return html
+
+    # Maps every @Node, including params, to the page of its top level item.
+    def _get_node_pages(self):
+        if self._node_pages is not None:
+            return self._node_pages
+
+        # url() lowercases names, so top level items that only differ in case
+        # would share a page. Later items get a numeric suffix instead.
+        top_pages = {}
+        used = set([DocatronWriter.INDEX_PAGE])
+        for top_node in self._nodes.values():
+            url = top_node.node.url()
+            page = '%s.html' % url
+            suffix = 1
+            while page in used:
+                suffix += 1
+                page = '%s-%d.html' % (url, suffix)
+            used.add(page)
+            top_pages[top_node] = page
+
+        node_pages = {}
+        for top_node, writer_node in self._iter_writer_nodes():
+            page = top_pages[top_node]
+            nodes = [writer_node.node]
+            while nodes:
+                node = nodes.pop()
+                node_pages[node] = page
+                nodes.extend(node.children)
+        self._node_pages = node_pages
+        return node_pages
+
+    # Yields (top level WriterNode, WriterNode) for every WriterNode in the
+    # order they appear in the document.
+    def _iter_writer_nodes(self):
+        def iter_children(top_node, writer_node):
+            yield top_node, writer_node
+            for children in writer_node.children.itervalues():
+                for child in children:
+                    for item in iter_children(top_node, child):
+                        yield item
+
+        for top_node in self._nodes.values():
+            for item in iter_children(top_node, top_node):
+                yield item
+
+    ## function DocatronWriter.get_search_index
+    ## Builds a search index of every documented item (but not params), to be
+    ## used by client side search instead of scanning the HTML. Besides the
+    ## symbols, it has a map from every lowercase prefix of each short and full
+    ## name, up to SEARCH_PREFIX_LENGTH characters, to the matching symbols. A
+    ## map from each lowercase trigram of the full names allows substring
+    ## searches by intersecting the lists of the query's trigrams.
+    ##
+    ## Params:
+    ##   pages (False) {boolean}: Whether the URLs should point to the page of
+    ##     each top level item, as written by @DocatronWriter.write_pages.
+    ##
+    ## Returns:
+    ##   {dict}: The index, with "symbols", "prefixes" and "trigrams" keys.
+    ##     Symbols have "name", "url", "type", "signature" and "description"
+    ##     keys. The prefix and trigram maps hold indexes into the symbols.
+    def get_search_index(self, pages=False):
+        symbols = []
+        prefixes = {}
+        trigrams = {}
+        max_length = DocatronWriter.SEARCH_PREFIX_LENGTH
+        for i, (_, writer_node) in enumerate(self._iter_writer_nodes()):
+            node = writer_node.node
+            url = '#%s' % node.url()
+            if pages:
+                url = self._get_node_pages()[node] + url
+            symbols.append({
+                'name': node.name,
+                'url': url,
+                'type': node.top_level_type,
+                'signature': _to_text(node.get_full_name()),
+                'description': _get_summary(node.description)
+            })
 
-            toc.append(FIRST_LEVEL_TOC % item)
+            keys = set()
+            for name in (node.name.lower(), node.get_short_name().lower()):
+                for length in xrange(1, min(len(name), max_length) + 1):
+                    keys.add(name[:length])
+            for key in keys:
+                prefixes.setdefault(key, []).append(i)
+
+            name = node.name.lower()
+            for key in set([name[j:j + 3] for j in xrange(len(name) - 2)]):
+                trigrams.setdefault(key, []).append(i)
+
+        return {
+            'symbols': symbols,
+            'prefixes': prefixes,
+            'trigrams': trigrams
+        }
 
-        return BASE_TOC % _indent_block('\n'.join(toc))
+    ## function DocatronWriter.write_search_index
+    ## Writes the search index from @DocatronWriter.get_search_index as
+    ## compact JSON.
+    ##
+    ## Params:
+    ##   f {file}: The open file to write to.
+    ##   pages (False) {boolean}: Whether the URLs should point to the page of
+    ##     each top level item.
+    def write_search_index(self, f, pages=False):
+        json.dump(self.get_search_index(pages), f, separators=(',', ':'),
+                  sort_keys=True)
 
     ## function DocatronWriter.write_html
-    ## Writes the nodes to HTML.
+    ## Writes the nodes to HTML. Each top level item is rendered, linked and
+    ## written on its own, so the whole document is never held in memory.
     ##
     ## Params:
     ##   f {file}: The open file to write to.
     def write_html(self, f):
-        html = []
-        for node in self._nodes.values():
-            html.append(BASE_ITEM_HTML % _indent_block(
-                node.to_html(top_level=True)))
+        _BASE_HTML.render(_HtmlBuffer(f=f), {
+            'toc': lambda out: self._render_table_of_contents(out, False),
+            'content': lambda out: self._write_items(
+                out, self._get_content_items())
+        })
+
+    ## function DocatronWriter.write_pages
+    ## Writes one page per top level item, named after the item's URL, and an
+    ## index page with the table of contents. Items whose names only differ in
+    ## case get a numeric suffix on all but the first page. A collapsed table
+    ## of contents also has its fragments written. A manifest of the pages'
+    ## content hashes is kept in the directory, and pages whose content has
+    ## not changed are not written again. Pages of items that no longer exist
+    ## are removed.
+    ##
+    ## Params:
+    ##   directory {string}: The directory to write the pages to.
+    ##   compress (False) {boolean}: Whether to also write compressed copies
+    ##     of every page, as @ArtifactFile does. The copies are in the
+    ##     manifest too.
+    ##   [search_index] {string}: Also write the search index from
+    ##     @DocatronWriter.write_search_index to this path in the directory,
+    ##     tracked in the manifest like the pages.
+    ##
+    ## Returns:
+    ##   {string[]}: The pages that were written.
+    def write_pages(self, directory, compress=False, search_index=None):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        manifest_path = os.path.join(directory, DocatronWriter.MANIFEST)
+        old_hashes = _read_manifest(manifest_path)
+
+        hashes = {}
+        written = []
+        for page in self.get_pages():
+            html = self.render_page(page)
+            if _write_artifact(directory, page, lambda f: f.write(html),
+                               compress, old_hashes, hashes):
+                written.append(page)
+        if search_index is not None:
+            write = lambda f: self.write_search_index(f, pages=True)
+            if _write_artifact(directory, search_index, write, compress,
+                               old_hashes, hashes):
+                written.append(search_index)
+
+        for name in old_hashes:
+            path = os.path.join(directory, name)
+            if name not in hashes and os.path.exists(path):
+                os.remove(path)
+
+        _write_manifest(manifest_path, hashes)
+        return written
+
+    ## function DocatronWriter.get_pages
+    ## Gets the pages written by @DocatronWriter.write_pages.
+    ##
+    ## Returns:
+    ##   {string[]}: The index page followed by one page per top level item,
+    ##     and then the fragments of a collapsed table of contents.
+    def get_pages(self):
+        return ([DocatronWriter.INDEX_PAGE] + self._get_page_nodes().keys() +
+                self.get_toc_fragments())
+
+    def _get_page_nodes(self):
+        if self._page_nodes is None:
+            node_pages = self._get_node_pages()
+            self._page_nodes = OrderedDict([(node_pages[n.node], n)
+                                            for n in self._nodes.values()])
+        return self._page_nodes
+
+    ## function DocatronWriter.render_page
+    ## Renders a single page of the output of @DocatronWriter.write_pages.
+    ##
+    ## Params:
+    ##   page {string}: One of the pages from @DocatronWriter.get_pages.
+    ##
+    ## Returns:
+    ##   {string}: The page as HTML, or JSON for a TOC fragment, or None if
+    ##     there is no such page.
+    def render_page(self, page):
+        if page in self._get_fragment_nodes():
+            return self.render_toc_fragment(page, pages=True)
+
+        index = DocatronWriter.INDEX_PAGE
+        if page == index:
+            toc = lambda out: self._render_table_of_contents(out, True)
+            content = ''
+        else:
+            node = self._get_page_nodes().get(page)
+            if node is None:
+                return None
+            toc = PAGE_TOC_HTML % {'index': index}
+            content = self._get_item_html(node, page)
+
+        out = _HtmlBuffer()
+        _BASE_HTML.render(out, {
+            'toc': toc,
+            'content': content
+        })
+        return out.getvalue()
+
+    ## function DocatronWriter.render_item
+    ## Renders a single documented item with its code and links converted,
+    ## without rendering anything else.
+    ##
+    ## Params:
+    ##   name {string}: The full name of the item.
+    ##   [page] {string}: The page the item will be shown on. Links to items on
+    ##     other pages include the page.
+    ##
+    ## Returns:
+    ##   {string}: The item as HTML, or None if there is no such item.
+    def render_item(self, name, page=None):
+        writer_node = self._get_writer_nodes().get(name)
+        if writer_node is None:
+            return None
+        if writer_node.node.name in self._nodes:
+            return self._get_item_html(writer_node, page)
+
+        out = _HtmlBuffer(functools.partial(self._convert, page))
+        writer_node._render(out)
+        return out.getvalue()
+
+    def _get_writer_nodes(self):
+        if self._writer_nodes is None:
+            self._writer_nodes = dict([(n.node.name, n)
+                                       for _, n in self._iter_writer_nodes()])
+        return self._writer_nodes
+
+    # Writes items into the buffer one per line. Items are already rendered
+    # with their code and links converted, so writing only indents them.
+    def _write_items(self, out, items):
+        for i, item in enumerate(items):
+            with self._stats.phase('write'):
+                if i:
+                    out.write('\n')
+                out.write(item)
+
+
+## class ArtifactFile
+## A file for deployed output that also writes gzip (".gz") and zlib (".zz")
+## compressed copies of itself, so servers can send them without compressing
+## on every request. The copies are compressed as the data is written, so the
+## output is never held in memory or read back. Python 2 has no brotli, so the
+## zlib copy, which is what HTTP calls "deflate", stands in for it. Each file
+## is written to a temporary name and only moved into place when the
+## @ArtifactFile is closed. Use it as a context manager to remove the
+## temporary files if writing fails.
+##
+## Params:
+##   filename {string}: The file to write.
+##   compress (True) {boolean}: Whether to write the compressed copies.
+##   [old_hashes] {dict}: Maps extensions, as in @ArtifactFile.hashes, to the
+##     hashes of the files from an earlier build. Files whose content has not
+##     changed are left alone.
+class ArtifactFile(object):
+    EXTENSIONS = ['.gz', '.zz']
+    LEVEL = 9
+
+    # The zlib window bits for each extension. 16 more than the largest
+    # window writes a gzip header and trailer instead of a zlib one.
+    _WBITS = {'.gz': 16 + zlib.MAX_WBITS, '.zz': zlib.MAX_WBITS}
+
+    def __init__(self, filename, compress=True, old_hashes=None):
+        self._filename = filename
+        self._old_hashes = old_hashes or {}
+        extensions = [''] + (ArtifactFile.EXTENSIONS if compress else [])
+        # [extension, temporary file, hash, compressor or None] per file.
+        self._files = []
+        try:
+            for extension in extensions:
+                compressor = None
+                if extension:
+                    compressor = zlib.compressobj(
+                        ArtifactFile.LEVEL, zlib.DEFLATED,
+                        ArtifactFile._WBITS[extension])
+                f = open(self._get_tmp_filename(extension), 'wb')
+                self._files.append([extension, f, hashlib.sha1(), compressor])
+        except:
+            self._abort()
+            raise
+
+        ## property ArtifactFile.hashes {dict}
+        ## Maps the extension of each file, "" for the uncompressed one, to
+        ## the SHA-1 hash of its content. Set when the file is closed.
+        self.hashes = None
+
+        ## property ArtifactFile.written {string[]}
+        ## The files that were replaced when the file was closed.
+        self.written = None
+
+    def _get_tmp_filename(self, extension):
+        return '%s%s.%d.tmp' % (self._filename, extension, os.getpid())
+
+    ## function ArtifactFile.write
+    ## Writes data to the file and its compressed copies.
+    ##
+    ## Params:
+    ##   data {string}: The data to write.
+    def write(self, data):
+        for _, f, digest, compressor in self._files:
+            if compressor is not None:
+                data_out = compressor.compress(data)
+            else:
+                data_out = data
+            if data_out:
+                f.write(data_out)
+                digest.update(data_out)
+
+    ## function ArtifactFile.close
+    ## Finishes the compressed copies and moves each file into place, unless
+    ## it has the same hash as in old_hashes and still exists.
+    ##
+    ## Returns:
+    ##   {dict}: The @ArtifactFile.hashes.
+    def close(self):
+        if self.hashes is not None:
+            return self.hashes
+
+        self.hashes = {}
+        self.written = []
+        for extension, f, digest, compressor in self._files:
+            if compressor is not None:
+                data = compressor.flush()
+                f.write(data)
+                digest.update(data)
+            f.close()
+
+            filename = self._filename + extension
+            tmp_filename = self._get_tmp_filename(extension)
+            self.hashes[extension] = digest.hexdigest()
+            if (self._old_hashes.get(extension) == self.hashes[extension] and
+                    os.path.exists(filename)):
+                os.remove(tmp_filename)
+            else:
+                os.rename(tmp_filename, filename)
+                self.written.append(filename)
+        return self.hashes
+
+    def _abort(self):
+        for extension, f, _, _ in self._files:
+            f.close()
+            os.remove(self._get_tmp_filename(extension))
+        self._files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self._abort()
 
-        f.write(self.create_links(self.sub_code(BASE_HTML % {
-            'toc': _indent_block(self.get_table_of_contents()),
-            'content': _indent_block('\n'.join(html))
-        })))
 
+## class FragmentCache
+## A least recently used cache of rendered HTML, bounded by the total length
+## of the cached strings. It is safe to share between threads and between
+## @DocatronRenderers.
+##
+## Params:
+##   max_bytes (67108864) {int}: The most HTML to keep.
+class FragmentCache(object):
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    ## function FragmentCache.get
+    ## Gets a cached fragment, marking it as recently used.
+    ##
+    ## Params:
+    ##   key {object}: The key the fragment was cached with.
+    ##
+    ## Returns:
+    ##   {string}: The fragment, or None if it is not cached.
+    def get(self, key):
+        with self._lock:
+            html = self._items.pop(key, None)
+            if html is not None:
+                self._items[key] = html
+            return html
+
+    ## function FragmentCache.put
+    ## Caches a fragment, dropping the least recently used ones if the cache
+    ## is full. Fragments bigger than the whole cache are not kept.
+    ##
+    ## Params:
+    ##   key {object}: The key to cache the fragment with.
+    ##   html {string}: The fragment.
+    def put(self, key, html):
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= len(old)
+            if len(html) > self._max_bytes:
+                return
+
+            self._items[key] = html
+            self._bytes += len(html)
+            while self._bytes > self._max_bytes:
+                _, old = self._items.popitem(last=False)
+                self._bytes -= len(old)
+
+
+## class DocatronRenderer
+## Renders pages and items on request instead of writing everything up front,
+## for serving docs from a long running process. Building one only assembles
+## the tree of @Nodes; nothing is rendered until it is asked for, and rendered
+## HTML is kept in a @FragmentCache.
+##
+## Params:
+##   nodes {@Node[]}: A list of nodes from @DocatronParser.get_nodes.
+##   [cache] {@FragmentCache}: The cache to use. Pass the same cache to many
+##     renderers to bound the memory they use together.
+##   [symbols] {@SymbolDatabase[]}: Symbols exported by other builds to link
+##     to.
+##   collapsed_toc (False) {boolean}: Whether the index page has a collapsed
+##     table of contents, with its fragments served as pages.
+class DocatronRenderer(object):
+    def __init__(self, nodes, cache=None, symbols=None, collapsed_toc=False):
+        self._writer = DocatronWriter(nodes, symbols=symbols,
+                                      collapsed_toc=collapsed_toc)
+        self._cache = cache if cache is not None else FragmentCache()
+        # Keeps this renderer's entries apart from others in a shared cache.
+        self._key = object()
+
+    ## function DocatronRenderer.get_pages
+    ## Gets the names of the pages that can be rendered.
+    ##
+    ## Returns:
+    ##   {string[]}: The index page followed by one page per top level item,
+    ##     and then the fragments of a collapsed table of contents.
+    def get_pages(self):
+        return self._writer.get_pages()
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser('DOCATRON documentation generator')
-    parser.add_argument('-t', default='///',
-                        help='Token to start DOCATRON comments (default "///")')
-    parser.add_argument('-o', help='File to write output to')
-    parser.add_argument('-i', default=2,
-                        help='Indent level for doc strings')
-    parser.add_argument('file', nargs='+', help='The files to parse')
-
-    args = parser.parse_args()
-    parser = DocatronParser(args.file, token=args.t, indent=args.i)
-    writer = DocatronWriter(parser.get_nodes())
-
-    if args.o:
-        with open(args.o, 'w') as f:
-            writer.write_html(f)
+    ## function DocatronRenderer.render_page
+    ## Renders a page, as @DocatronWriter.render_page does.
+    ##
+    ## Params:
+    ##   page {string}: One of the pages from @DocatronRenderer.get_pages.
+    ##
+    ## Returns:
+    ##   {string}: The page as HTML, or JSON for a TOC fragment, or None if
+    ##     there is no such page.
+    def render_page(self, page):
+        return self._get_cached(('page', page), self._writer.render_page, page)
+
+    ## function DocatronRenderer.render_item
+    ## Renders a single item, as @DocatronWriter.render_item does.
+    ##
+    ## Params:
+    ##   name {string}: The full name of the item.
+    ##   [page] {string}: The page the item will be shown on.
+    ##
+    ## Returns:
+    ##   {string}: The item as HTML, or None if there is no such item.
+    def render_item(self, name, page=None):
+        return self._get_cached(('item', name, page), self._writer.render_item,
+                                name, page)
+
+    def _get_cached(self, key, render, *args):
+        key = (self._key,) + key
+        html = self._cache.get(key)
+        if html is None:
+            html = render(*args)
+            if html is not None:
+                self._cache.put(key, html)
+        return html
+
+
+## class BuildStats
+## Collects the wall time, number of calls and peak memory of each phase of a
+## build, along with the time spent on each file and the size of each rendered
+## top level item. Pass it to @DocatronParser and @DocatronWriter.
+class BuildStats(object):
+    def __init__(self):
+        # Phase name => [seconds, calls, max RSS in KB at the end of a call].
+        self._phases = OrderedDict()
+        self._files = []
+        self._items = []
+
+    ## function BuildStats.phase
+    ## A context manager that times one call of a phase.
+    ##
+    ## Params:
+    ##   name {string}: The name of the phase.
+    ##   calls (1) {int}: How many calls this counts as.
+    @contextmanager
+    def phase(self, name, calls=1):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add_phase(name, time.time() - start, calls)
+
+    ## function BuildStats.add_phase
+    ## Adds time spent in a phase that was measured without
+    ## @BuildStats.phase, e.g. because it is interleaved with another phase.
+    ##
+    ## Params:
+    ##   name {string}: The name of the phase.
+    ##   seconds {float}: The time spent in the phase.
+    ##   calls (1) {int}: How many calls this counts as.
+    def add_phase(self, name, seconds, calls=1):
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        phase = self._phases.setdefault(name, [0.0, 0, 0])
+        phase[0] += seconds
+        phase[1] += calls
+        phase[2] = max(phase[2], max_rss)
+
+    def add_file(self, filename, seconds, num_nodes):
+        self._files.append((seconds, filename, num_nodes))
+
+    def add_item(self, name, num_bytes):
+        self._items.append((num_bytes, name))
+
+    ## function BuildStats.to_dict
+    ## Gets the collected stats, e.g. to be saved as JSON.
+    ##
+    ## Params:
+    ##   top (10) {int}: How many of the slowest files and largest items to
+    ##     include.
+    ##
+    ## Returns:
+    ##   {dict}: The phases, slowest files and largest items.
+    def to_dict(self, top=10):
+        return {
+            'phases': [{
+                'name': name,
+                'seconds': seconds,
+                'calls': calls,
+                'max_rss_kb': max_rss
+            } for name, (seconds, calls, max_rss) in self._phases.iteritems()],
+            'slowest_files': [{
+                'file': filename,
+                'seconds': seconds,
+                'nodes': num_nodes
+            } for seconds, filename, num_nodes in
+                sorted(self._files, reverse=True)[:top]],
+            'largest_items': [{
+                'name': name,
+                'bytes': num_bytes
+            } for num_bytes, name in sorted(self._items, reverse=True)[:top]]
+        }
+
+    ## function BuildStats.format
+    ## Formats the collected stats as text.
+    ##
+    ## Params:
+    ##   top (10) {int}: How many of the slowest files and largest items to
+    ##     include.
+    ##
+    ## Returns:
+    ##   {string}: The stats as a table.
+    def format(self, top=10):
+        stats = self.to_dict(top)
+        lines = ['%-16s %10s %10s %14s' % ('phase', 'seconds', 'calls',
+                                           'max RSS (KB)')]
+        for phase in stats['phases']:
+            lines.append('%(name)-16s %(seconds)10.3f %(calls)10d '
+                         '%(max_rss_kb)14d' % phase)
+        lines.append('')
+        lines.append('Slowest files:')
+        for f in stats['slowest_files']:
+            lines.append('  %(seconds)8.3fs %(nodes)6d nodes  %(file)s' % f)
+        lines.append('')
+        lines.append('Largest items:')
+        for item in stats['largest_items']:
+            lines.append('  %(bytes)10d bytes  %(name)s' % item)
+        return '\n'.join(lines)
+
+
+class _NoStats(object):
+    @contextmanager
+    def phase(self, name, calls=1):
+        yield
+
+    def add_phase(self, name, seconds, calls=1):
+        pass
+
+    def add_file(self, filename, seconds, num_nodes):
+        pass
+
+    def add_item(self, name, num_bytes):
+        pass
+
+
+_NO_STATS = _NoStats()
+
+
+# Translates a glob to a regex the way .gitignore does: "*", "?" and "[...]"
+# never match "/", and "**" between slashes matches any number of
+# directories.
+def _translate_glob(pattern):
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        at_dir_start = i == 0 or pattern[i - 1] == '/'
+        c = pattern[i]
+        if at_dir_start and pattern.startswith('**/', i):
+            parts.append('(?:.*/)?')
+            i += 3
+        elif at_dir_start and pattern.startswith('**', i) and i + 2 == n:
+            parts.append('.*')
+            i += 2
+        elif c == '*':
+            parts.append('[^/]*')
+            i += 1
+        elif c == '?':
+            parts.append('[^/]')
+            i += 1
+        elif c == '[':
+            j = i + 1
+            if j < n and pattern[j] == '!':
+                j += 1
+            if j < n and pattern[j] == ']':
+                j += 1
+            while j < n and pattern[j] != ']':
+                j += 1
+            if j >= n:
+                parts.append('\\[')
+                i += 1
+                continue
+            chars = pattern[i + 1:j].replace('\\', '\\\\')
+            if chars[0] == '!':
+                chars = '^/' + chars[1:]
+            elif chars[0] == '^':
+                chars = '\\' + chars
+            parts.append('[%s]' % chars)
+            i = j + 1
+        else:
+            parts.append(re.escape(c))
+            i += 1
+    return '%s\\Z' % ''.join(parts)
+
+
+# A rule from an ignore file. Rules with a slash before the end match the path
+# relative to the directory of the ignore file, others match the name.
+class _IgnoreRule(object):
+    __slots__ = ('base', 'negate', 'dir_only', 'anchored', 'regex')
+
+    def __init__(self, pattern, base):
+        self.base = base
+        self.negate = pattern.startswith('!')
+        if self.negate or pattern.startswith('\\'):
+            pattern = pattern[1:]
+        self.dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        self.anchored = '/' in pattern
+        self.regex = re.compile(_translate_glob(pattern.lstrip('/')), re.S)
+
+    def matches(self, path, name, is_dir):
+        if self.dir_only and not is_dir:
+            return False
+        if self.anchored:
+            name = os.path.relpath(path, self.base).replace(os.sep, '/')
+        return self.regex.match(name) is not None
+
+
+def _read_ignore_rules(directory, names):
+    rules = []
+    for name in names:
+        with open(os.path.join(directory, name)) as f:
+            for line in f:
+                line = line.rstrip()
+                if line and not line.startswith('#'):
+                    rules.append(_IgnoreRule(line, directory))
+    return rules
+
+
+# Whether the last rule matching the path ignores it.
+def _is_ignored(rules, path, name, is_dir):
+    ignored = False
+    for rule in rules:
+        # Only rules that would change the result need to be matched.
+        if rule.negate == ignored and rule.matches(path, name, is_dir):
+            ignored = not rule.negate
+    return ignored
+
+
+def _compile_globs(globs):
+    if not globs:
+        return None
+    return re.compile('|'.join(['(?:%s)' % _translate_glob(g)
+                                for g in globs]), re.S)
+
+
+# Yields the files under root in sorted order. Skipped directories are never
+# entered.
+def _walk(root, include, exclude):
+    dir_rules = {root: []}
+    for dirpath, dirnames, filenames in os.walk(root):
+        rules = dir_rules.pop(dirpath)
+        ignore_files = [n for n in IGNORE_FILES if n in filenames]
+        if ignore_files:
+            rules = rules + _read_ignore_rules(dirpath, ignore_files)
+        rel_dir = os.path.relpath(dirpath, root).replace(os.sep, '/')
+
+        def skip(name, is_dir):
+            rel = name if rel_dir == '.' else '%s/%s' % (rel_dir, name)
+            if exclude.match(name) or exclude.match(rel):
+                return True
+            if rules:
+                return _is_ignored(rules, os.path.join(dirpath, name), name,
+                                   is_dir)
+            return False
+
+        dirnames[:] = sorted([d for d in dirnames if not skip(d, True)])
+        for name in dirnames:
+            dir_rules[os.path.join(dirpath, name)] = rules
+
+        for name in sorted(filenames):
+            if name in IGNORE_FILES or skip(name, False):
+                continue
+            if include is not None:
+                rel = name if rel_dir == '.' else '%s/%s' % (rel_dir, name)
+                if not (include.match(name) or include.match(rel)):
+                    continue
+            yield os.path.join(dirpath, name)
+
+
+_GLOB_CHARS_RE = re.compile(r'[*?[]')
+
+
+## function find_files
+## Finds the files to parse from a list of files, directories and globs.
+## Directories are searched recursively in sorted order. Paths matched by
+## DEFAULT_EXCLUDE, the exclude globs or the ignore files in IGNORE_FILES are
+## skipped without being opened, and skipped directories are not entered.
+## Files are yielded as they are found, so they can be passed straight to
+## @DocatronParser.
+##
+## Params:
+##   paths {string[]}: Files, directories and globs. Files that are named or
+##     matched by a glob are always yielded.
+##   [include] {string[]}: Globs that files found in directories must match,
+##     by name or by path from the directory given.
+##   [exclude] {string[]}: Globs of files and directories to skip, by name or
+##     by path from the directory given.
+##
+## Returns:
+##   {generator}: The filenames.
+def find_files(paths, include=None, exclude=None):
+    include = _compile_globs(include)
+    exclude = _compile_globs(DEFAULT_EXCLUDE + list(exclude or []))
+    for path in paths:
+        names = [path]
+        if _GLOB_CHARS_RE.search(path) and not os.path.exists(path):
+            names = sorted(glob.glob(path))
+        for name in names:
+            if os.path.isdir(name):
+                for filename in _walk(os.path.normpath(name), include,
+                                      exclude):
+                    yield filename
+            else:
+                yield name
+
+
+def _read_manifest(filename):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return {}
+
+
+def _write_manifest(filename, hashes):
+    with open(filename, 'w') as f:
+        json.dump(hashes, f, indent=0, sort_keys=True)
+
+
+# Writes a file in the directory through an @ArtifactFile, which leaves it
+# alone if its hash in old_hashes has not changed, and records the new hashes
+# by name in hashes. Returns the files that were written.
+def _write_artifact(directory, name, write, compress, old_hashes, hashes):
+    path = os.path.join(directory, name)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    extensions = [''] + (ArtifactFile.EXTENSIONS if compress else [])
+    with ArtifactFile(path, compress, dict([
+            (extension, old_hashes.get(name + extension))
+            for extension in extensions])) as f:
+        write(f)
+    for extension, digest in f.hashes.iteritems():
+        hashes[name + extension] = digest
+    return f.written
+
+
+# Writes the HTML, and the search index if it is given as a path relative to
+# the HTML's directory, with their compressed copies. Their hashes are added
+# to the manifest in that directory, which may be shared with other outputs.
+def _write_precompressed(writer, filename, search_index=None):
+    directory = os.path.dirname(filename) or '.'
+    manifest_path = os.path.join(directory, DocatronWriter.MANIFEST)
+    hashes = _read_manifest(manifest_path)
+    written = _write_artifact(directory, os.path.basename(filename),
+                              writer.write_html, True, hashes, hashes)
+    if search_index is not None:
+        written += _write_artifact(directory, search_index,
+                                   writer.write_search_index, True, hashes,
+                                   hashes)
+    _write_manifest(manifest_path, hashes)
+    return written
+
+
+# Removes the compressed copies and manifest entries left by an earlier build
+# with --precompress, which would be out of date.
+def _remove_precompressed(filename):
+    for extension in ArtifactFile.EXTENSIONS:
+        if os.path.exists(filename + extension):
+            os.remove(filename + extension)
+
+    manifest_path = os.path.join(os.path.dirname(filename) or '.',
+                                 DocatronWriter.MANIFEST)
+    if not os.path.exists(manifest_path):
+        return
+    hashes = _read_manifest(manifest_path)
+    names = [os.path.basename(filename) + extension
+             for extension in [''] + ArtifactFile.EXTENSIONS]
+    if any([name in hashes for name in names]):
+        for name in names:
+            hashes.pop(name, None)
+        _write_manifest(manifest_path, hashes)
+
+
+def _write_if_changed(writer, filename, compress=False, search_index=None):
+    # Called even without fragments, to remove those of an earlier build.
+    written = writer.write_toc_fragments(os.path.dirname(filename) or '.',
+                                         compress)
+    if compress:
+        return written + _write_precompressed(writer, filename, search_index)
+    _remove_precompressed(filename)
+
+    tmp_filename = '%s.%d.tmp' % (filename, os.getpid())
+    with open(tmp_filename, 'w') as f:
+        writer.write_html(f)
+    if (os.path.exists(filename) and
+            filecmp.cmp(tmp_filename, filename, shallow=False)):
+        os.remove(tmp_filename)
+        return written
+    os.rename(tmp_filename, filename)
+    return written + [filename]
+
+
+def _get_stat(filename):
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime, stat.st_size)
+
+
+## function watch
+## Polls files for changes, parsing only the files that changed and writing the
+## output again. Runs until interrupted.
+##
+## Params:
+##   parser {@DocatronParser}: The parser the files were parsed with.
+##   files {string[]}: The files to watch.
+##   write {function}: Called with a @DocatronWriter to write the output.
+##     Returns the list of files that were actually written.
+##   interval (1.0) {float}: Seconds to wait between polls.
+##   [symbols] {@SymbolDatabase[]}: Symbols exported by other builds to link
+##     to. They are read again for every write.
+##   collapsed_toc (False) {boolean}: Whether to write a collapsed table of
+##     contents.
+##   [find] {function}: Called on every poll to find the files to watch again,
+##     e.g. with @find_files, so files added to watched directories are parsed
+##     and removed files are dropped. Returns the files in order.
+def watch(parser, files, write, interval=1.0, symbols=None,
+          collapsed_toc=False, find=None):
+    make_writer = lambda: DocatronWriter(parser.get_nodes(), symbols=symbols,
+                                         collapsed_toc=collapsed_toc)
+    write(make_writer())
+    stats = dict([(name, _get_stat(name)) for name in files])
+    while True:
+        time.sleep(interval)
+        if find is not None:
+            files = find()
+        changed = []
+        for name in files:
+            stat = _get_stat(name)
+            if name not in stats or stat != stats[name]:
+                stats[name] = stat
+                changed.append(name)
+        removed = set(stats).difference(files)
+        for name in removed:
+            del stats[name]
+        if not changed and not removed:
+            continue
+
+        start = time.time()
+        try:
+            parser.update(changed, files)
+        except (DocatronSyntaxError, EnvironmentError) as e:
+            print >> sys.stderr, e
+            continue
+        written = write(make_writer())
+        print >> sys.stderr, '%d file(s) changed, wrote %d file(s) in %.2fs' % (
+            len(changed) + len(removed), len(written), time.time() - start)
+
+
+# Arguments for finding and parsing files, used by the default and parse
+# commands.
+def _add_parse_arguments(arg_parser):
+    arg_parser.add_argument('-t', default='///',
+                            help='Token to start DOCATRON comments (default '
+                                 '"///")')
+    arg_parser.add_argument('-i', default=2,
+                            help='Indent level for doc strings')
+    arg_parser.add_argument('-c', help='Directory to cache parsed files in')
+    arg_parser.add_argument('-j', '--jobs', type=int, default=1,
+                            help='Number of processes to parse files with')
+    arg_parser.add_argument('-r', '--readers', type=int, default=0,
+                            help='Number of threads to read files ahead of '
+                                 'parsing with, for slow file systems')
+    arg_parser.add_argument('--include', action='append',
+                            help='Only parse files in directories matching '
+                                 'this glob (can be repeated)')
+    arg_parser.add_argument('--exclude', action='append',
+                            help='Skip files and directories matching this '
+                                 'glob (can be repeated)')
+    arg_parser.add_argument('file', nargs='+',
+                            help='The files, directories or globs to parse')
+
+
+# Arguments for writing the output, used by the default and render commands.
+def _add_write_arguments(arg_parser):
+    arg_parser.add_argument('-o', help='File to write output to')
+    arg_parser.add_argument('-d', help='Directory to write one page per top '
+                                       'level item to, instead of a single '
+                                       'file')
+    arg_parser.add_argument('-s', '--search-index',
+                            help='Also write a JSON search index to this file')
+    arg_parser.add_argument('--symbols', action='append',
+                            help='Symbol database from another build to link '
+                                 'to (can be repeated)')
+    arg_parser.add_argument('--export-symbols',
+                            help='Also write the symbols to this database for '
+                                 'other builds to link to')
+    arg_parser.add_argument('--symbols-url', default='',
+                            help='Where these docs are published, for links '
+                                 'from other builds to the exported symbols')
+    arg_parser.add_argument('--collapsed-toc', action='store_true',
+                            help='Only list top level items in the table of '
+                                 'contents and load their children from JSON '
+                                 'fragments when clicked (needs -o or -d)')
+    arg_parser.add_argument('--precompress', action='store_true',
+                            help='Also write gzip (.gz) and zlib (.zz) copies '
+                                 'of the output, with their hashes in '
+                                 'manifest.json (needs -o or -d)')
+    arg_parser.add_argument('--warn-unresolved', action='store_true',
+                            help='Print "@Name" references that do not match '
+                                 'anything')
+
+
+def _check_write_arguments(arg_parser, args):
+    for flag, value in (('--collapsed-toc', args.collapsed_toc),
+                        ('--precompress', args.precompress)):
+        if value and not (args.o or args.d):
+            arg_parser.error('%s needs an output file (-o) or directory (-d)' %
+                             flag)
+    if (args.precompress and args.search_index and
+            _get_output_name(args, args.search_index).startswith('../')):
+        arg_parser.error('--precompress needs the search index (-s) in the '
+                         'output directory')
+
+
+# The path of a file relative to the output directory, as used in manifests.
+def _get_output_name(args, filename):
+    directory = args.d or os.path.dirname(args.o) or '.'
+    return os.path.relpath(filename, directory).replace(os.sep, '/')
+
+
+def _add_stats_arguments(arg_parser):
+    arg_parser.add_argument('--stats', action='store_true',
+                            help='Print time, calls and peak memory per '
+                                 'phase, the slowest files and the largest '
+                                 'items')
+    arg_parser.add_argument('--stats-json',
+                            help='Also write the stats to this file as JSON')
+
+
+def _get_build_stats(args):
+    if args.stats or args.stats_json:
+        return BuildStats()
+    return None
+
+
+def _parse_files(args, stats):
+    files = find_files(args.file, args.include, args.exclude)
+    return DocatronParser(files, token=args.t, indent=args.i,
+                          cache_dir=args.c, jobs=args.jobs, stats=stats,
+                          readers=args.readers)
+
+
+# Writes the docs the arguments ask for, for a build and for every rebuild in
+# watch mode. Returns the files that were written.
+def _write_docs(args, writer):
+    # Precompressed search indexes are tracked in the output's manifest.
+    index_name = None
+    if args.precompress and args.search_index:
+        index_name = _get_output_name(args, args.search_index)
+
+    if args.d:
+        written = writer.write_pages(args.d, args.precompress, index_name)
+    elif args.o:
+        written = _write_if_changed(writer, args.o, args.precompress,
+                                    index_name)
     else:
         writer.write_html(sys.stdout)
+        written = []
+
+    if args.search_index and index_name is None:
+        with open(args.search_index, 'w') as f:
+            writer.write_search_index(f, pages=bool(args.d))
+        _remove_precompressed(args.search_index)
+        written.append(args.search_index)
+
+    if args.export_symbols:
+        writer.export_symbols(SymbolDatabase(args.export_symbols),
+                              args.symbols_url, pages=bool(args.d))
+        written.append(args.export_symbols)
+
+    if args.warn_unresolved:
+        for filename, lineno, name in writer.get_unresolved_links():
+            print >> sys.stderr, '%s line %s: unresolved link @%s' % (
+                filename, lineno, name)
+    return written
+
+
+def _write_output(args, nodes, stats):
+    symbols = [SymbolDatabase(name) for name in args.symbols or []]
+    writer = DocatronWriter(nodes, stats=stats, symbols=symbols,
+                            collapsed_toc=args.collapsed_toc)
+    _write_docs(args, writer)
+
+
+def _report_stats(args, stats):
+    if args.stats:
+        print >> sys.stderr, stats.format()
+    if args.stats_json:
+        with open(args.stats_json, 'w') as f:
+            json.dump(stats.to_dict(), f, indent=2)
+
+
+# "docatron.py parse" parses files to a @NodeFile for "docatron.py render".
+def _main_parse(argv):
+    arg_parser = argparse.ArgumentParser(
+        'docatron.py parse',
+        description='Parse files to an intermediate file that the render '
+                    'command can merge with others and write')
+    arg_parser.add_argument('-o', required=True,
+                            help='Intermediate file to write the parsed '
+                                 'nodes to')
+    _add_parse_arguments(arg_parser)
+    _add_stats_arguments(arg_parser)
+    args = arg_parser.parse_args(argv)
+
+    stats = _get_build_stats(args)
+    parser = _parse_files(args, stats)
+    with (stats or _NO_STATS).phase('save'):
+        NodeFile(args.o).write(parser.get_parsed_files())
+    _report_stats(args, stats)
+
+
+def _main_render(argv):
+    arg_parser = argparse.ArgumentParser(
+        'docatron.py render',
+        description='Merge intermediate files from the parse command and '
+                    'write the output')
+    _add_write_arguments(arg_parser)
+    _add_stats_arguments(arg_parser)
+    arg_parser.add_argument('node_file', nargs='+',
+                            help='The intermediate files to render, merged in '
+                                 'order')
+    args = arg_parser.parse_args(argv)
+    _check_write_arguments(arg_parser, args)
+
+    stats = _get_build_stats(args)
+    parser = DocatronParser([], stats=stats)
+    with (stats or _NO_STATS).phase('load'):
+        for name in args.node_file:
+            parser.add_parsed_files(NodeFile(name).read())
+    _write_output(args, parser.get_nodes(), stats)
+    _report_stats(args, stats)
+
+
+def _main(argv):
+    arg_parser = argparse.ArgumentParser(
+        'DOCATRON documentation generator',
+        epilog='Use "docatron.py parse" and "docatron.py render" to parse and '
+               'write in separate steps.')
+    _add_parse_arguments(arg_parser)
+    _add_write_arguments(arg_parser)
+    arg_parser.add_argument('-w', '--watch', action='store_true',
+                            help='Keep running and regenerate the output when '
+                                 'files are changed, added or removed (needs '
+                                 '-o or -d)')
+    arg_parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds between checks for changes in watch '
+                                 'mode (default 1)')
+    _add_stats_arguments(arg_parser)
+    args = arg_parser.parse_args(argv)
+    if args.watch and not (args.o or args.d):
+        arg_parser.error('--watch needs an output file (-o) or directory (-d)')
+    if args.watch and (args.stats or args.stats_json):
+        arg_parser.error('--stats and --stats-json cannot be used with '
+                         '--watch')
+    _check_write_arguments(arg_parser, args)
+
+    stats = _get_build_stats(args)
+    parser = _parse_files(args, stats)
+    if args.watch:
+        symbols = [SymbolDatabase(name) for name in args.symbols or []]
+        write = lambda writer: _write_docs(args, writer)
+        find = lambda: list(find_files(args.file, args.include,
+                                       args.exclude))
+        try:
+            watch(parser, parser.get_files(), write, args.interval, symbols,
+                  args.collapsed_toc, find)
+        except KeyboardInterrupt:
+            pass
+        return
+
+    _write_output(args, parser.get_nodes(), stats)
+    _report_stats(args, stats)
+
+
+if __name__ == '__main__':
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command == 'parse':
+        _main_parse(sys.argv[2:])
+    elif command == 'render':
+        _main_render(sys.argv[2:])
+    else:
+        _main(sys.argv[1:])
@@ -0,0 +1,510 @@
+import gzip
+import hashlib
+import json
+import marshal
+import os
+import shutil
+import tempfile
+import unittest
+import zlib
+
+import docatron
+
+
+class IgnoreRuleTest(unittest.TestCase):
+    def _matches(self, pattern, path, is_dir=False):
+        rule = docatron._IgnoreRule(pattern, '/root')
+        return rule.matches('/root/' + path, path.split('/')[-1], is_dir)
+
+    def test_name_matches_at_any_depth(self):
+        self.assertTrue(self._matches('*.py', 'a.py'))
+        self.assertTrue(self._matches('*.py', 'sub/deep/a.py'))
+        self.assertFalse(self._matches('*.py', 'a.pyc'))
+
+    def test_slash_anchors_to_base(self):
+        self.assertTrue(self._matches('sub/*.py', 'sub/a.py'))
+        self.assertFalse(self._matches('sub/*.py', 'other/sub/a.py'))
+        self.assertTrue(self._matches('/a.py', 'a.py'))
+        self.assertFalse(self._matches('/a.py', 'sub/a.py'))
+
+    def test_star_does_not_match_slash(self):
+        self.assertFalse(self._matches('sub/*', 'sub/deep/a.py'))
+        self.assertFalse(self._matches('sub/?/a.py', 'sub///a.py'))
+        self.assertFalse(self._matches('sub[!x]a.py', 'sub/a.py'))
+
+    def test_leading_double_star_matches_any_depth(self):
+        self.assertTrue(self._matches('**/deep/*.py', 'deep/e.py'))
+        self.assertTrue(self._matches('**/deep/*.py', 'sub/deep/e.py'))
+        self.assertTrue(self._matches('**/deep/*.py', 'a/b/deep/e.py'))
+        self.assertFalse(self._matches('**/deep/*.py', 'sub/deep/x/e.py'))
+
+    def test_middle_and_trailing_double_star(self):
+        self.assertTrue(self._matches('a/**/b', 'a/b'))
+        self.assertTrue(self._matches('a/**/b', 'a/x/y/b'))
+        self.assertTrue(self._matches('a/**', 'a/x/y'))
+        self.assertFalse(self._matches('a/**', 'b/x'))
+
+    def test_dir_only(self):
+        self.assertTrue(self._matches('build/', 'build', is_dir=True))
+        self.assertFalse(self._matches('build/', 'build'))
+
+    def test_last_matching_rule_wins(self):
+        rules = [docatron._IgnoreRule('*.js', '/root'),
+                 docatron._IgnoreRule('!keep.js', '/root')]
+        self.assertTrue(docatron._is_ignored(rules, '/root/a.js', 'a.js',
+                                             False))
+        self.assertFalse(docatron._is_ignored(rules, '/root/keep.js',
+                                              'keep.js', False))
+
+
+class FindFilesTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ['a.js', 'sub/b.js', 'sub/deep/d.js', 'sub/deep/e.py',
+                     'sub/f.py', 'node_modules/g.js']:
+            path = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _find(self, include=None, exclude=None):
+        return [os.path.relpath(name, self.root) for name in
+                docatron.find_files([self.root], include, exclude)]
+
+    def test_default_exclude(self):
+        self.assertEqual(self._find(), [
+            'a.js', 'sub/b.js', 'sub/f.py', 'sub/deep/d.js', 'sub/deep/e.py'])
+
+    def test_include_star_stays_in_directory(self):
+        self.assertEqual(self._find(include=['sub/*']),
+                         ['sub/b.js', 'sub/f.py'])
+        self.assertEqual(self._find(include=['sub/**/*.js']),
+                         ['sub/b.js', 'sub/deep/d.js'])
+
+    def test_exclude_by_name_and_path(self):
+        self.assertEqual(self._find(exclude=['*.py', 'sub/deep']),
+                         ['a.js', 'sub/b.js'])
+
+    def test_gitignore_double_star(self):
+        with open(os.path.join(self.root, '.gitignore'), 'w') as f:
+            f.write('# comment\n**/deep/*.py\n')
+        self.assertEqual(self._find(), [
+            'a.js', 'sub/b.js', 'sub/f.py', 'sub/deep/d.js'])
+
+    def test_nested_ignore_file_is_relative_to_its_directory(self):
+        with open(os.path.join(self.root, 'sub', '.docatronignore'), 'w') as f:
+            f.write('/b.js\ndeep/\n')
+        self.assertEqual(self._find(), ['a.js', 'sub/f.py'])
+
+
+class ParallelParseTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, name, text):
+        path = os.path.join(self.root, name)
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+    def _error(self, files, jobs):
+        try:
+            docatron.DocatronParser(files, jobs=jobs)
+        except docatron.DocatronSyntaxError as e:
+            return str(e)
+        self.fail('no error')
+
+    def test_nodes_are_in_input_order(self):
+        files = [self._write('f%d.js' % i, '/// class C%d\n/// c\nx\n\n' % i)
+                 for i in range(20)]
+        self.assertEqual(
+            docatron.DocatronParser(files, jobs=3).get_nodes().keys(),
+            docatron.DocatronParser(files).get_nodes().keys())
+
+    def test_first_error_matches_one_job(self):
+        files = [self._write('f0.js', '/// class A\n/// a\nx\n\n'),
+                 self._write('f1.js', '/// class A\n/// a\nx\n\n'),
+                 self._write('f2.js', '/// class B\n///    bad\nx\n\n')]
+        error = self._error(files, 1)
+        self.assertTrue(error.startswith('duplicate nodes'), error)
+        self.assertEqual(self._error(files, 2), error)
+
+    def test_update_adds_and_drops_files(self):
+        a = self._write('a.js', '/// class A\n/// a\nx\n\n')
+        b = self._write('b.js', '/// class B\n/// b\nx\n\n')
+        parser = docatron.DocatronParser([a])
+        parser.update([], [b, a])
+        self.assertEqual(parser.get_nodes().keys(), ['B', 'A'])
+        parser.update([], [b])
+        self.assertEqual(parser.get_files(), [b])
+        self.assertEqual(parser.get_nodes().keys(), ['B'])
+
+
+class ParseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.root, 'cache')
+        self.path = os.path.join(self.root, 'a.js')
+        self._write('/// class A\n/// a\nx\n\n')
+        self.parsed = []
+        self._parse_file = parse_file = docatron.DocatronParser._parse_file
+
+        def count_parse(parser, contents, filename):
+            self.parsed.append(filename)
+            return parse_file(parser, contents, filename)
+        docatron.DocatronParser._parse_file = count_parse
+
+    def tearDown(self):
+        docatron.DocatronParser._parse_file = self._parse_file
+        shutil.rmtree(self.root)
+
+    def _write(self, text):
+        with open(self.path, 'w') as f:
+            f.write(text)
+
+    def _parse(self, **kwargs):
+        self.parsed = []
+        return docatron.DocatronParser([self.path], cache_dir=self.cache_dir,
+                                       **kwargs).get_nodes().keys()
+
+    def test_hit_and_miss(self):
+        self.assertEqual(self._parse(), ['A'])
+        self.assertEqual(self.parsed, [self.path])
+        self.assertEqual(self._parse(), ['A'])
+        self.assertEqual(self.parsed, [])
+
+    def test_changed_contents_are_parsed_again(self):
+        self._parse()
+        self._write('/// class B\n/// b\nx\n\n')
+        os.utime(self.path, (0, 0))
+        self.assertEqual(self._parse(), ['B'])
+        self.assertEqual(self.parsed, [self.path])
+
+    def test_touched_file_is_not_parsed_again(self):
+        self._parse()
+        os.utime(self.path, (0, 0))
+        self.assertEqual(self._parse(), ['A'])
+        self.assertEqual(self.parsed, [])
+        self.assertEqual(self._parse(), ['A'])
+        self.assertEqual(self.parsed, [])
+
+    def test_settings_invalidate(self):
+        self._parse()
+        self._parse(indent=4)
+        self.assertEqual(self.parsed, [self.path])
+
+        cache = docatron.ParseCache(self.cache_dir, '///', 4)
+        self.assertEqual(cache.load_stat(self.path),
+                         docatron._get_stat(self.path))
+        cache = docatron.ParseCache(self.cache_dir, '///', 2)
+        self.assertEqual(cache.load_stat(self.path), None)
+        version = docatron.ParseCache.VERSION
+        docatron.ParseCache.VERSION = version + 1
+        try:
+            cache = docatron.ParseCache(self.cache_dir, '///', 4)
+            self.assertEqual(cache.load(self.path), None)
+        finally:
+            docatron.ParseCache.VERSION = version
+
+    def test_corrupt_entry_is_a_miss(self):
+        self._parse()
+        for name in os.listdir(self.cache_dir):
+            with open(os.path.join(self.cache_dir, name), 'wb') as f:
+                f.write('not a pickle')
+        self.assertEqual(self._parse(), ['A'])
+        self.assertEqual(self.parsed, [self.path])
+
+
+class ReadAheadTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.files = []
+        for i in range(4):
+            path = os.path.join(self.root, 'f%d.js' % i)
+            with open(path, 'w') as f:
+                f.write('/// class C%d\n/// c\nx\n\n' % i)
+            self.files.append(path)
+        self.read = []
+        self._read_contents = docatron._read_contents
+        docatron._read_contents = self._count_read
+
+    def tearDown(self):
+        docatron._read_contents = self._read_contents
+        shutil.rmtree(self.root)
+
+    def _count_read(self, filename):
+        self.read.append(filename)
+        return self._read_contents(filename)
+
+    def _parse(self):
+        self.read = []
+        parser = docatron.DocatronParser(
+            self.files, cache_dir=os.path.join(self.root, 'cache'), readers=2)
+        return parser.get_nodes().keys()
+
+    def test_cached_files_are_not_read(self):
+        names = self._parse()
+        self.assertEqual(sorted(self.read), self.files)
+        self.assertEqual(self._parse(), names)
+        self.assertEqual(self.read, [])
+
+        os.utime(self.files[2], (0, 0))
+        self.assertEqual(self._parse(), names)
+        self.assertEqual(self.read, [self.files[2]])
+
+
+class NodeFileTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.filename = os.path.join(self.root, 'a.nodes')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _render(self, parser):
+        return docatron.DocatronWriter(parser.get_nodes()).render_item('A')
+
+    def test_round_trip(self):
+        path = os.path.join(self.root, 'a.js')
+        with open(path, 'w') as f:
+            f.write('/// class A\n'
+                    '/// See @A.f and |code|.\n'
+                    '///\n'
+                    '///     example(@A);\n'
+                    'x\n\n'
+                    '/// function A.f\n'
+                    '/// F.\n'
+                    '///\n'
+                    '/// Params:\n'
+                    '///   [x] ({}) {@A}: An @A.\n'
+                    '///\n'
+                    '/// Returns:\n'
+                    '///   {int}: One.\n'
+                    'x\n\n')
+        parser = docatron.DocatronParser([path])
+        docatron.NodeFile(self.filename).write(parser.get_parsed_files())
+
+        loaded = docatron.DocatronParser([])
+        loaded.add_parsed_files(docatron.NodeFile(self.filename).read())
+        self.assertEqual(loaded.get_files(), [path])
+        self.assertEqual(loaded.get_nodes().keys(), ['A', 'A.f'])
+        self.assertEqual(loaded.get_nodes()['A.f'].filename, path)
+        self.assertEqual(self._render(loaded), self._render(parser))
+
+    def _read_error(self, data):
+        with open(self.filename, 'wb') as f:
+            marshal.dump(data, f)
+        try:
+            docatron.NodeFile(self.filename).read()
+        except IOError as e:
+            return str(e)
+        self.fail('no error')
+
+    def test_other_version_is_rejected(self):
+        error = self._read_error((docatron.NodeFile.MAGIC,
+                                  docatron.NodeFile.VERSION + 1, ()))
+        self.assertTrue('unsupported node file version' in error, error)
+
+    def test_other_file_is_rejected(self):
+        error = self._read_error(('something else', 1, ()))
+        self.assertTrue('not a DOCATRON node file' in error, error)
+        with open(self.filename, 'wb') as f:
+            f.write('\x00garbage')
+        self.assertRaises(IOError, docatron.NodeFile(self.filename).read)
+
+
+class SymbolDatabaseTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_dotted_name_without_parent(self):
+        path = os.path.join(self.root, 'a.js')
+        with open(path, 'w') as f:
+            f.write('/// function util.helper\n'
+                    '/// See @util.helper.\n'
+                    'x\n\n')
+        writer = docatron.DocatronWriter(
+            docatron.DocatronParser([path]).get_nodes())
+        self.assertTrue('href="#function-util-helper"' in
+                        writer.render_item('util.helper'))
+
+        database = docatron.SymbolDatabase(os.path.join(self.root, 'a.db'))
+        writer.export_symbols(database, 'lib/')
+        self.assertEqual(database.read(), {
+            'util.helper': ('lib/', 'function-util-helper',
+                            'function-util-helper')
+        })
+
+
+class UnresolvedLinksTest(unittest.TestCase):
+    def test_reports_whole_reference(self):
+        f = tempfile.NamedTemporaryFile(suffix='.js', delete=False)
+        try:
+            f.write('/// class x-y\n'
+                    '/// See @x-y, @x-yx, @nope and @foo$bar.\n'
+                    'x\n\n')
+            f.close()
+            writer = docatron.DocatronWriter(
+                docatron.DocatronParser([f.name]).get_nodes())
+            self.assertEqual(
+                [name for _, _, name in writer.get_unresolved_links()],
+                ['x-yx', 'nope', 'foo$bar'])
+        finally:
+            os.remove(f.name)
+
+    def test_reports_line_of_reference(self):
+        f = tempfile.NamedTemporaryFile(suffix='.js', delete=False)
+        try:
+            f.write('/// function f\n'
+                    '/// First line,\n'
+                    '/// then @a.\n'
+                    '///\n'
+                    '/// Params:\n'
+                    '///   x {@b}: An\n'
+                    '///     @c.\n'
+                    '///\n'
+                    '/// Returns:\n'
+                    '///   {@d}: @e.\n'
+                    'x\n\n')
+            f.close()
+            writer = docatron.DocatronWriter(
+                docatron.DocatronParser([f.name]).get_nodes())
+            self.assertEqual(
+                [(lineno, name) for _, lineno, name in
+                 writer.get_unresolved_links()],
+                [(3, 'a'), (6, 'b'), (7, 'c'), (10, 'd'), (10, 'e')])
+        finally:
+            os.remove(f.name)
+
+
+class FragmentCacheTest(unittest.TestCase):
+    def _cached(self, cache, keys):
+        return [key for key in keys if cache.get(key) is not None]
+
+    def test_least_recently_used_is_evicted(self):
+        cache = docatron.FragmentCache(max_bytes=10)
+        cache.put('a', 'aaaa')
+        cache.put('b', 'bbbb')
+        self.assertEqual(cache.get('a'), 'aaaa')
+        cache.put('c', 'cccc')
+        self.assertEqual(self._cached(cache, 'abc'), ['a', 'c'])
+
+    def test_size_is_bounded(self):
+        cache = docatron.FragmentCache(max_bytes=10)
+        for key in 'abcdef':
+            cache.put(key, key * 3)
+        self.assertEqual(self._cached(cache, 'abcdef'), ['d', 'e', 'f'])
+
+        cache.put('d', 'd' * 8)
+        self.assertEqual(self._cached(cache, 'abcdef'), ['d'])
+        self.assertEqual(cache._bytes, 8)
+
+    def test_fragment_bigger_than_cache_is_not_kept(self):
+        cache = docatron.FragmentCache(max_bytes=10)
+        cache.put('a', 'aaaa')
+        cache.put('a', 'a' * 11)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache._bytes, 0)
+
+
+class ArtifactFileTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.filename = os.path.join(self.root, 'a.html')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, data, old_hashes=None):
+        with docatron.ArtifactFile(self.filename, old_hashes=old_hashes) as f:
+            f.write(data[:5])
+            f.write(data[5:])
+        return f
+
+    def _read(self, extension):
+        with open(self.filename + extension, 'rb') as f:
+            return f.read()
+
+    def test_hashes_and_compressed_copies(self):
+        data = '<p>hello</p>' * 100
+        f = self._write(data)
+        self.assertEqual(gzip.GzipFile(self.filename + '.gz').read(), data)
+        self.assertEqual(zlib.decompress(self._read('.zz')), data)
+        self.assertEqual(self._read(''), data)
+        self.assertEqual(sorted(f.hashes), ['', '.gz', '.zz'])
+        for extension, digest in f.hashes.items():
+            self.assertEqual(hashlib.sha1(self._read(extension)).hexdigest(),
+                             digest)
+        self.assertEqual(sorted(f.written),
+                         [self.filename + extension
+                          for extension in sorted(f.hashes)])
+
+    def test_unchanged_files_are_not_replaced(self):
+        hashes = self._write('<p>a</p>').hashes
+        os.utime(self.filename, (0, 0))
+        f = self._write('<p>a</p>', hashes)
+        self.assertEqual(f.hashes, hashes)
+        self.assertEqual(f.written, [])
+        self.assertEqual(os.stat(self.filename).st_mtime, 0)
+
+        os.remove(self.filename + '.gz')
+        f = self._write('<p>a</p>', hashes)
+        self.assertEqual(f.written, [self.filename + '.gz'])
+        f = self._write('<p>b</p>', hashes)
+        self.assertEqual(len(f.written), 3)
+        self.assertEqual(self._read(''), '<p>b</p>')
+
+    def test_failed_write_leaves_no_files(self):
+        try:
+            with docatron.ArtifactFile(self.filename) as f:
+                f.write('<p>a</p>')
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(os.listdir(self.root), [])
+
+
+class TocFragmentsTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, 'a.js')
+        with open(self.path, 'w') as f:
+            f.write('/// class A\n/// a\nx\n\n'
+                    '/// function A.f\n/// f\nx\n\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write(self, collapsed_toc):
+        writer = docatron.DocatronWriter(
+            docatron.DocatronParser([self.path]).get_nodes(),
+            collapsed_toc=collapsed_toc)
+        writer.write_toc_fragments(self.root, compress=True)
+
+    def _manifest(self):
+        with open(os.path.join(self.root, docatron.DocatronWriter.MANIFEST)) \
+                as f:
+            return sorted(json.load(f))
+
+    def test_fragments_removed_when_not_collapsed(self):
+        self._write(True)
+        self.assertEqual(self._manifest(), [
+            'toc/class-a.json', 'toc/class-a.json.gz', 'toc/class-a.json.zz'])
+        os.remove(os.path.join(self.root, 'toc', 'class-a.json.gz'))
+
+        self._write(False)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'toc')))
+        self.assertEqual(self._manifest(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()